@@ -0,0 +1,166 @@
+"""
+Synthetic JupyterHub and Prometheus APIs for benchmarking the exporter.
+
+Responses are rendered once and served from memory, so the fake servers spend
+as little time as possible per request and do not skew the measurements.
+"""
+
+import json
+import multiprocessing
+import socket
+import time
+
+from aiohttp import web
+
+
+def _usernames(users: int) -> list:
+    return [f"user-{i}" for i in range(users)]
+
+
+def _memberships(users: int, groups: int, memberships: int) -> list:
+    """
+    Spread the group memberships of each user evenly over the groups.
+    """
+    memberships = min(memberships, groups)
+    return [
+        sorted({f"group-{(i + k * 7) % groups}" for k in range(memberships)})
+        for i in range(users)
+    ]
+
+
+def hub_app(users: int, groups: int, memberships: int, page_size: int = 200):
+    """
+    Serve paginated hub/api/users and hub/api/groups like JupyterHub does.
+    """
+    usernames = _usernames(users)
+    user_groups = _memberships(users, groups, memberships)
+    user_models = [
+        {"kind": "user", "name": name, "admin": False, "groups": member_of}
+        for name, member_of in zip(usernames, user_groups)
+    ]
+    group_members = {f"group-{i}": [] for i in range(groups)}
+    for name, member_of in zip(usernames, user_groups):
+        for group in member_of:
+            group_members[group].append(name)
+    group_models = [
+        {"kind": "group", "name": name, "users": members}
+        for name, members in group_members.items()
+    ]
+    pages = {}
+
+    def paginated(items: list):
+        async def handler(request: web.Request):
+            offset = int(request.query.get("offset", 0))
+            limit = min(int(request.query.get("limit", page_size)), page_size)
+            key = (request.path, offset, limit)
+            if key not in pages:
+                end = min(offset + limit, len(items))
+                next_page = None
+                if end < len(items):
+                    next_page = {
+                        "offset": end,
+                        "limit": limit,
+                        "url": str(request.url.with_query(offset=end, limit=limit)),
+                    }
+                pages[key] = json.dumps(
+                    {
+                        "items": items[offset:end],
+                        "_pagination": {
+                            "offset": offset,
+                            "limit": limit,
+                            "total": len(items),
+                            "next": next_page,
+                        },
+                    }
+                ).encode()
+            return web.Response(body=pages[key], content_type="application/json")
+
+        return handler
+
+    app = web.Application()
+    app.router.add_get("/hub/api/users", paginated(user_models))
+    app.router.add_get("/hub/api/groups", paginated(group_models))
+    return app
+
+
+def prometheus_app(series: int, samples: int = 1, namespace: str = "benchmark"):
+    """
+    Serve the same usage series for every api/v1/query and api/v1/query_range.
+    """
+    usernames = _usernames(series)
+
+    def labels(name: str) -> dict:
+        return {
+            "annotation_hub_jupyter_org_username": name,
+            "namespace": namespace,
+            "username": name,
+        }
+
+    vector = [
+        {"metric": labels(name), "value": [1700000000.0, str(i)]}
+        for i, name in enumerate(usernames)
+    ]
+    matrix = [
+        {
+            "metric": labels(name),
+            "values": [[1700000000.0 + 15 * j, str(i + j)] for j in range(samples)],
+        }
+        for i, name in enumerate(usernames)
+    ]
+    bodies = {
+        result_type: json.dumps(
+            {"status": "success", "data": {"resultType": result_type, "result": result}}
+        ).encode()
+        for result_type, result in (("vector", vector), ("matrix", matrix))
+    }
+
+    async def query(request: web.Request):
+        return web.Response(body=bodies["vector"], content_type="application/json")
+
+    async def query_range(request: web.Request):
+        return web.Response(body=bodies["matrix"], content_type="application/json")
+
+    app = web.Application()
+    app.router.add_get("/api/v1/query", query)
+    app.router.add_get("/api/v1/query_range", query_range)
+    return app
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _serve(app_factory: callable, kwargs: dict, port: int):
+    web.run_app(app_factory(**kwargs), host="127.0.0.1", port=port, print=None)
+
+
+class FakeUpstream:
+    """
+    Run a fake upstream API in a separate process, so that it does not compete
+    with the exporter for the event loop being measured.
+    """
+
+    def __init__(self, app_factory: callable, **kwargs):
+        self.port = _free_port()
+        self.url = f"http://127.0.0.1:{self.port}"
+        self._process = multiprocessing.Process(
+            target=_serve, args=(app_factory, kwargs, self.port), daemon=True
+        )
+
+    def __enter__(self):
+        self._process.start()
+        deadline = time.monotonic() + 30
+        while time.monotonic() < deadline:
+            try:
+                socket.create_connection(("127.0.0.1", self.port), timeout=1).close()
+                return self
+            except OSError:
+                time.sleep(0.05)
+        self.__exit__()
+        raise RuntimeError(f"Fake upstream did not start on port {self.port}")
+
+    def __exit__(self, *exc_info):
+        self._process.terminate()
+        self._process.join()
@@ -0,0 +1,126 @@
+"""
+Micro-benchmark of the join of Prometheus series with user group memberships.
+
+Compares the original join, which deep-copied every series for each group of
+its user, with _join_user_groups, timing both and tracing their peak memory,
+e.g.
+
+    python -m benchmarks.join --series 20000 --samples 5
+"""
+
+import argparse
+import copy
+import json
+import time
+import tracemalloc
+
+from jupyterhub_groups_exporter.groups_exporter import _join_user_groups
+
+
+def deepcopy_join(results: list, user_group_map: dict) -> dict:
+    """
+    Join series with groups by deep-copying them, as update_group_usage used to.
+    """
+    joined = []
+    for r in results:
+        username = r["metric"]["username"]
+        groups = user_group_map.get(username, [])
+        if not groups:
+            r_copy = copy.deepcopy(r)
+            r_copy["metric"]["usergroup"] = "none"
+            joined.append(r_copy)
+        else:
+            for group in groups:
+                r_copy = copy.deepcopy(r)
+                r_copy["metric"]["usergroup"] = group
+                joined.append(r_copy)
+    return {
+        (j["metric"]["usergroup"], j["metric"]["username"]): float(j["values"][-1][-1])
+        for j in joined
+    }
+
+
+def generator_join(results: list, user_group_map: dict) -> dict:
+    """
+    Join series with groups with the _join_user_groups generator.
+    """
+    return {
+        (usergroup, username): value
+        for username, usergroup, value in _join_user_groups(results, user_group_map)
+    }
+
+
+def synthetic_results(series: int, samples: int, groups: int, memberships: int):
+    """
+    Build a Prometheus range query result and a user group map for it.
+    """
+    results = [
+        {
+            "metric": {"namespace": "benchmark", "username": f"user-{i}"},
+            "values": [[t * 15, f"{i + t}"] for t in range(samples)],
+        }
+        for i in range(series)
+    ]
+    user_group_map = {
+        f"user-{i}": [f"group-{(i + k) % groups}" for k in range(memberships)]
+        for i in range(series)
+    }
+    return results, user_group_map
+
+
+def measure(join: callable, results: list, user_group_map: dict) -> dict:
+    tracemalloc.start()
+    try:
+        start = time.perf_counter()
+        samples = join(results, user_group_map)
+        seconds = time.perf_counter() - start
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return {"seconds": seconds, "peak_memory_bytes": peak, "samples": len(samples)}
+
+
+def run_benchmark(
+    series: int = 20000, samples: int = 5, groups: int = 10, memberships: int = 2
+) -> dict:
+    """
+    Run both joins on the same synthetic results and return their measurements.
+    """
+    results, user_group_map = synthetic_results(series, samples, groups, memberships)
+    if deepcopy_join(results, user_group_map) != generator_join(
+        results, user_group_map
+    ):
+        raise RuntimeError("The joins disagree.")
+    return {
+        "parameters": dict(
+            series=series, samples=samples, groups=groups, memberships=memberships
+        ),
+        "results": {
+            "deepcopy_join": measure(deepcopy_join, results, user_group_map),
+            "generator_join": measure(generator_join, results, user_group_map),
+        },
+    }
+
+
+def main():
+    argparser = argparse.ArgumentParser(
+        description="Compare the deep-copying join of Prometheus series with user groups with _join_user_groups."
+    )
+    argparser.add_argument(
+        "--series", default=20000, type=int, help="Number of Prometheus series."
+    )
+    argparser.add_argument(
+        "--samples", default=5, type=int, help="Number of samples per series."
+    )
+    argparser.add_argument("--groups", default=10, type=int, help="Number of groups.")
+    argparser.add_argument(
+        "--memberships", default=2, type=int, help="Number of groups per user."
+    )
+    args = argparser.parse_args()
+
+    results = run_benchmark(args.series, args.samples, args.groups, args.memberships)
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,272 @@
+"""
+Benchmark the exporter against synthetic JupyterHub and Prometheus APIs.
+
+Times update_user_group_info, update_group_usage and the metrics handler end to
+end, records their peak traced memory and prints the results as JSON, e.g.
+
+    python -m benchmarks.run --users 10000 --groups 100 --output results.json
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import platform
+import resource
+import statistics
+import sys
+import time
+import tracemalloc
+
+from aiohttp.test_utils import make_mocked_request
+
+from jupyterhub_groups_exporter import decoding
+from jupyterhub_groups_exporter._version import __version__
+from jupyterhub_groups_exporter.app import handle, on_cleanup, on_startup, sub_app
+from jupyterhub_groups_exporter.exposition import EXPOSITION
+from jupyterhub_groups_exporter.groups_exporter import (
+    update_group_usage,
+    update_user_group_info,
+)
+from jupyterhub_groups_exporter.metrics import EXPORTER_REGISTRY
+
+from .fake_upstreams import FakeUpstream, hub_app, prometheus_app
+
+
+async def _measure(step: callable, repeat: int) -> dict:
+    """
+    Time repeated runs of a step, then trace the peak memory of one more run.
+    """
+    seconds = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        await step()
+        seconds.append(time.perf_counter() - start)
+    tracemalloc.start()
+    try:
+        await step()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return {
+        "seconds": seconds,
+        "min_seconds": min(seconds),
+        "median_seconds": statistics.median(seconds),
+        "peak_memory_bytes": peak,
+    }
+
+
+async def _scrape(accept_encoding: str = None, invalidate: bool = False) -> int:
+    if invalidate:
+        EXPOSITION.invalidate()
+    headers = {"Accept-Encoding": accept_encoding} if accept_encoding else {}
+    response = await handle(make_mocked_request("GET", "/", headers=headers))
+    return len(response.body)
+
+
+async def run_benchmark(
+    users: int = 1000,
+    groups: int = 10,
+    memberships: int = 2,
+    series: int = None,
+    samples: int = 20,
+    page_size: int = 200,
+    repeat: int = 5,
+    **options,
+) -> dict:
+    """
+    Run the benchmark at the given scale and return the results.
+
+    Other keyword arguments override the exporter options passed to sub_app.
+    """
+    series = users if series is None else series
+    parameters = dict(
+        users=users,
+        groups=groups,
+        memberships=memberships,
+        series=series,
+        samples=samples,
+        page_size=page_size,
+        repeat=repeat,
+    )
+    with (
+        FakeUpstream(
+            hub_app,
+            users=users,
+            groups=groups,
+            memberships=memberships,
+            page_size=page_size,
+        ) as hub,
+        FakeUpstream(prometheus_app, series=series, samples=samples) as prom,
+    ):
+        settings = dict(
+            headers={
+                "Accept": "application/jupyterhub-pagination+json",
+                "Authorization": "token benchmark",
+            },
+            hub_url=hub.url,
+            hubs=None,
+            hub_api_concurrency=8,
+            hub_connection_limit=8,
+            allowed_groups=[],
+            double_count=True,
+            namespace="benchmark",
+            jupyterhub_metrics_prefix="jupyterhub",
+            update_info_interval=3600,
+            full_sync_interval=0,
+            update_metrics_interval=15,
+            update_dirsize_interval=7200,
+            adaptive_intervals=False,
+            max_interval_factor=4,
+            prometheus_host="127.0.0.1",
+            prometheus_port=prom.port,
+            prometheus_connection_limit=8,
+            dns_cache_ttl=300,
+            keepalive_timeout=60,
+            prometheus_query_mode="range",
+            prometheus_eval_offset=0,
+            prometheus_streaming=False,
+            usage_aggregation="user",
+            label_profiles={"default": "full"},
+            max_series_per_metric=0,
+            user_trace_rate=0,
+            snapshot_path=None,
+            username_cache_size=max(100000, users),
+            worker_pool="none",
+            worker_pool_size=4,
+        )
+        settings.update(options)
+        app = sub_app(**settings)
+        await on_startup(app)
+        # Run the update jobs one at a time instead of on their schedule
+        await app["scheduler"].stop()
+        usage_jobs = [
+            config
+            for jobs in app["scheduler"].batches.values()
+            for update_function, config in jobs
+            if update_function is update_group_usage
+        ]
+        try:
+            results = {}
+            start = time.perf_counter()
+            await update_user_group_info(app, {})
+            results["update_user_group_info_first_seconds"] = (
+                time.perf_counter() - start
+            )
+            results["update_user_group_info"] = await _measure(
+                lambda: update_user_group_info(app, {}), repeat
+            )
+            results["update_group_usage"] = await _measure(
+                lambda: update_group_usage(app, usage_jobs[0]), repeat
+            )
+            # Populate all usage metrics before measuring scrapes
+            for config in usage_jobs:
+                await update_group_usage(app, config)
+            results["handle"] = await _measure(lambda: _scrape(invalidate=True), repeat)
+            results["handle_cached"] = await _measure(_scrape, repeat)
+            results["handle_gzip"] = await _measure(
+                lambda: _scrape("gzip", invalidate=True), repeat
+            )
+            exposition_bytes = await _scrape(invalidate=True)
+        finally:
+            await on_cleanup(app)
+    return {
+        "parameters": parameters,
+        "options": {k: v for k, v in settings.items() if k != "headers"},
+        "environment": {
+            "exporter_version": __version__,
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "json_backend": decoding.BACKEND,
+        },
+        "series": {
+            family.name: len(family.samples) for family in EXPORTER_REGISTRY.collect()
+        },
+        "exposition_bytes": exposition_bytes,
+        "results": results,
+        "max_rss_bytes": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+    }
+
+
+def main():
+    argparser = argparse.ArgumentParser(
+        description="Benchmark the exporter against synthetic JupyterHub and Prometheus APIs."
+    )
+    argparser.add_argument(
+        "--users", default=1000, type=int, help="Number of hub users."
+    )
+    argparser.add_argument(
+        "--groups", default=10, type=int, help="Number of hub groups."
+    )
+    argparser.add_argument(
+        "--memberships", default=2, type=int, help="Number of groups per user."
+    )
+    argparser.add_argument(
+        "--series",
+        default=None,
+        type=int,
+        help="Number of series per Prometheus query. Default is one per user.",
+    )
+    argparser.add_argument(
+        "--samples", default=20, type=int, help="Number of samples per range series."
+    )
+    argparser.add_argument(
+        "--page_size", default=200, type=int, help="Maximum page size of the hub API."
+    )
+    argparser.add_argument(
+        "--repeat", default=5, type=int, help="Number of timed runs of each step."
+    )
+    argparser.add_argument(
+        "--prometheus_query_mode", default="range", choices=["instant", "range"]
+    )
+    argparser.add_argument("--prometheus_streaming", action="store_true")
+    argparser.add_argument(
+        "--usage_aggregation", default="user", choices=["user", "group", "both"]
+    )
+    argparser.add_argument(
+        "--label_profile", default="full", choices=["full", "join_only", "minimal"]
+    )
+    argparser.add_argument(
+        "--worker_pool", default="none", choices=["none", "thread", "process"]
+    )
+    argparser.add_argument("--worker_pool_size", default=4, type=int)
+    argparser.add_argument(
+        "--output", default="-", help="File to write the JSON results to."
+    )
+    args = argparser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    results = asyncio.run(
+        run_benchmark(
+            users=args.users,
+            groups=args.groups,
+            memberships=args.memberships,
+            series=args.series,
+            samples=args.samples,
+            page_size=args.page_size,
+            repeat=args.repeat,
+            prometheus_query_mode=args.prometheus_query_mode,
+            prometheus_streaming=args.prometheus_streaming,
+            usage_aggregation=args.usage_aggregation,
+            label_profiles={"default": args.label_profile},
+            worker_pool=args.worker_pool,
+            worker_pool_size=args.worker_pool_size,
+        )
+    )
+    output = json.dumps(results, indent=2)
+    if args.output == "-":
+        print(output)
+    else:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    for step, result in results["results"].items():
+        if isinstance(result, dict):
+            print(
+                f"{step}: median {result['median_seconds'] * 1000:.1f} ms, "
+                f"peak {result['peak_memory_bytes'] / 2**20:.1f} MiB",
+                file=sys.stderr,
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,139 @@
+"""
+Scaling benchmark of building the user group map from hub user models.
+
+Compares the original list scans of update_user_group_info with
+_build_user_group_map at several hub sizes, e.g.
+
+    python -m benchmarks.user_group_map --users 1000 10000 100000
+
+The original implementation is quadratic in the number of users, so it is only
+run up to --max_list_scan_users users.
+"""
+
+import argparse
+import json
+import random
+import time
+from collections import Counter
+
+from jupyterhub_groups_exporter.groups_exporter import _build_user_group_map
+
+
+def list_scan_user_group_map(users: list, allowed_groups: list):
+    """
+    Build the user group map with list scans, as update_user_group_info used to.
+    """
+    list_users = []
+    for r in users:
+        if r["kind"] == "user":
+            for group in r["groups"]:
+                if group in allowed_groups or allowed_groups == []:
+                    list_users.append(r["name"])
+    user_counts = Counter(list_users)
+    users_in_multiple_groups = [
+        user for user, count in user_counts.items() if count > 1
+    ]
+    unique_users = list(set(list_users))
+    user_to_groups = {}
+    for r in users:
+        user = r["name"]
+        if r["kind"] == "user" and user in unique_users:
+            if r["groups"] != []:
+                for group in r["groups"]:
+                    user_to_groups.setdefault(user, []).append(group)
+        elif r["kind"] == "user":
+            user_to_groups.setdefault(user, ["none"])
+    for user in list(user_to_groups.keys()):
+        if user in users_in_multiple_groups:
+            user_to_groups[user].append("multiple")
+    return user_to_groups, set(users_in_multiple_groups)
+
+
+def synthetic_users(users: int, groups: int, seed: int = 0) -> list:
+    """
+    Build hub user models with random memberships of up to three groups.
+    """
+    rng = random.Random(seed)
+    group_names = [f"group-{i}" for i in range(groups)]
+    return [
+        {
+            "kind": "user",
+            "name": f"user-{i}",
+            "groups": rng.sample(group_names, rng.randint(0, 3)),
+        }
+        for i in range(users)
+    ]
+
+
+def measure(build: callable, users: list, allowed_groups: list):
+    start = time.perf_counter()
+    user_group_map = build(users, allowed_groups)
+    return time.perf_counter() - start, user_group_map
+
+
+def run_benchmark(
+    users: list = (1000, 10000, 100000),
+    groups: int = 50,
+    allowed: int = 25,
+    max_list_scan_users: int = 10000,
+) -> dict:
+    """
+    Time both implementations at each number of users and return the results.
+
+    The list scans are skipped, and reported as None, above max_list_scan_users.
+    """
+    allowed_groups = [f"group-{i}" for i in range(allowed)]
+    results = {}
+    for n in users:
+        models = synthetic_users(n, groups)
+        seconds, user_group_map = measure(_build_user_group_map, models, allowed_groups)
+        result = {"build_user_group_map_seconds": seconds}
+        if n <= max_list_scan_users:
+            seconds, expected = measure(
+                list_scan_user_group_map, models, allowed_groups
+            )
+            if user_group_map != expected:
+                raise RuntimeError(f"The user group maps of {n} users disagree.")
+            result["list_scan_seconds"] = seconds
+        else:
+            result["list_scan_seconds"] = None
+        results[n] = result
+    return {
+        "parameters": dict(
+            groups=groups, allowed=allowed, max_list_scan_users=max_list_scan_users
+        ),
+        "results": results,
+    }
+
+
+def main():
+    argparser = argparse.ArgumentParser(
+        description="Compare the list scans of the original user group map with _build_user_group_map."
+    )
+    argparser.add_argument(
+        "--users",
+        default=[1000, 10000, 100000],
+        type=int,
+        nargs="+",
+        help="Numbers of hub users to benchmark.",
+    )
+    argparser.add_argument("--groups", default=50, type=int, help="Number of groups.")
+    argparser.add_argument(
+        "--allowed", default=25, type=int, help="Number of allowed groups."
+    )
+    argparser.add_argument(
+        "--max_list_scan_users",
+        default=10000,
+        type=int,
+        help="Largest number of users to run the quadratic list scans for.",
+    )
+    args = argparser.parse_args()
+
+    results = run_benchmark(
+        args.users, args.groups, args.allowed, args.max_list_scan_users
+    )
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -4,18 +4,36 @@ Application backend to fetch user group memberships from the JupyterHub API and
 
 import argparse
 import asyncio
+import hmac
+import json
 import logging
 import os
+import re
+from collections import ChainMap
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
-import aiohttp
 from aiohttp import web
-from prometheus_client import (
-    generate_latest,
-)
 from yarl import URL
 
-from .groups_exporter import update_group_usage, update_user_group_info
-from .metrics import CONFIG_COMPUTE, CONFIG_DIRSIZE
+from .exposition import render_metrics
+from .groups_exporter import (
+    USER_TRACE,
+    USERNAMES,
+    apply_membership_deltas,
+    restore_user_group_map,
+    update_group_usage,
+    update_user_group_info,
+)
+from .metrics import (
+    CONFIG_COMPUTE,
+    CONFIG_DIRSIZE,
+    LABEL_PROFILES,
+    SCRAPE_DURATION,
+    USER_GROUP,
+    SnapshotGauge,
+)
+from .scheduler import Scheduler
+from .sessions import client_session
 
 logger = logging.getLogger(__name__)
 
@@ -27,79 +45,279 @@ def _str_to_bool(value: str) -> bool:
         return False
 
 
+def _label_profiles(value: str) -> dict:
+    """
+    Parse a default label profile and per-metric overrides, e.g.
+    "join_only,jupyterhub_user_group_home_dir_bytes=full".
+    """
+    usage_metrics = {cfg["metric"].name for cfg in CONFIG_COMPUTE + CONFIG_DIRSIZE}
+    profiles = {"default": "full"}
+    for entry in value.split(","):
+        metric, _, profile = entry.strip().rpartition("=")
+        if profile not in LABEL_PROFILES:
+            raise argparse.ArgumentTypeError(f"unknown label profile '{profile}'")
+        if metric and metric not in usage_metrics:
+            raise argparse.ArgumentTypeError(f"unknown usage metric '{metric}'")
+        profiles[metric or "default"] = profile
+    return profiles
+
+
+# Kubernetes namespace names, which are safe to join into a PromQL regex
+NAMESPACE_NAME = re.compile(r"[a-z0-9]([-a-z0-9]{0,61}[a-z0-9])?")
+
+
+def _hubs(value: str) -> list:
+    """
+    Read the hubs of multi-hub mode from a JSON file, e.g.
+    [{"namespace": "hub-a", "hub_url": "http://hub.hub-a.svc:8081", "api_token_env": "HUB_A_TOKEN"}].
+    """
+    try:
+        with open(value) as f:
+            entries = json.load(f)
+        hubs = [
+            {
+                "namespace": entry["namespace"],
+                "hub_url": entry["hub_url"],
+                "api_token": entry.get("api_token")
+                or os.environ[entry["api_token_env"]],
+            }
+            for entry in entries
+        ]
+    except (OSError, KeyError, TypeError, ValueError) as e:
+        raise argparse.ArgumentTypeError(f"invalid hubs file '{value}': {e!r}")
+    namespaces = [hub["namespace"] for hub in hubs]
+    for name in namespaces:
+        if not isinstance(name, str) or not NAMESPACE_NAME.fullmatch(name):
+            raise argparse.ArgumentTypeError(
+                f"invalid hub namespace {name!r} in '{value}'"
+            )
+    if len(set(namespaces)) != len(namespaces):
+        raise argparse.ArgumentTypeError(f"duplicate hub namespaces in '{value}'")
+    return hubs
+
+
+def _hub_state(app: web.Application, hub: dict) -> ChainMap:
+    """
+    Return the state of one hub in multi-hub mode. Keys not set for the hub
+    fall through to the app, so all hubs share its options and worker pool.
+    """
+    snapshot_path = app["snapshot_path"]
+    return ChainMap(
+        {
+            "namespace": hub["namespace"],
+            "hub_url": URL(hub["hub_url"]),
+            "hub_session": client_session(
+                "hub",
+                headers=dict(app["headers"], Authorization=f"token {hub['api_token']}"),
+                connection_limit=app["hub_connection_limit"],
+                dns_cache_ttl=app["dns_cache_ttl"],
+                keepalive_timeout=app["keepalive_timeout"],
+            ),
+            "snapshot_path": (
+                f"{snapshot_path}.{hub['namespace']}" if snapshot_path else None
+            ),
+        },
+        app,
+    )
+
+
+def _usage_job(app: web.Application, cfg: dict, update_interval: int) -> dict:
+    label_profiles = app["label_profiles"]
+    label_profile = label_profiles.get(cfg["metric"].name, label_profiles["default"])
+    cfg["metric"].relabel(LABEL_PROFILES[label_profile])
+    return dict(cfg, update_interval=update_interval, label_profile=label_profile)
+
+
 async def handle(request: web.Request):
+    with SCRAPE_DURATION.time():
+        body, headers = render_metrics(
+            accept=request.headers.get("Accept"),
+            accept_encoding=request.headers.get("Accept-Encoding"),
+        )
     return web.Response(
-        body=generate_latest(),
+        body=body,
         status=200,
-        content_type="text/plain",
+        headers=headers,
     )
 
 
-async def background_update(
-    app: web.Application, config: dict, update_function: callable
-):
-    while True:
-        try:
-            data = await update_function(app, config)
-            logger.debug(f"Fetched data for {update_function.__name__}: {data}")
-        except Exception as e:
-            logger.error(f"Error fetching data for {update_function.__name__}: {e}")
-        await asyncio.sleep(int(config["update_interval"]))
+async def handle_memberships(request: web.Request):
+    """
+    Apply group membership deltas pushed by the hub, authenticated with the push token.
+    """
+    scheme, _, token = request.headers.get("Authorization", "").partition(" ")
+    if scheme.lower() not in ("token", "bearer") or not hmac.compare_digest(
+        token.encode(), request.app["push_token"].encode()
+    ):
+        raise web.HTTPUnauthorized(text="Invalid or missing push token.")
+    hubs = request.app.get("hub_states") or [request.app]
+    hub = hubs[0]
+    if len(hubs) > 1:
+        namespace = request.query.get("namespace")
+        hub = next((h for h in hubs if h["namespace"] == namespace), None)
+        if hub is None:
+            raise web.HTTPNotFound(text=f"Unknown hub namespace: {namespace}")
+    try:
+        deltas = (await request.json())["deltas"]
+        if not isinstance(deltas, list):
+            raise ValueError("deltas must be a list")
+        changed = await apply_membership_deltas(hub, deltas)
+    except (KeyError, TypeError, ValueError) as e:
+        raise web.HTTPBadRequest(text=f"Invalid membership deltas: {e}")
+    if changed is None:
+        raise web.HTTPServiceUnavailable(
+            text="User group memberships have not been initialized yet."
+        )
+    logger.info(f"Applied {len(deltas)} membership deltas, changing {changed} users.")
+    return web.json_response({"changed": changed})
 
 
 async def on_startup(app):
-    app["session"] = aiohttp.ClientSession(headers=app["headers"])
-    logger.info("Client session started.")
-    app["task"] = asyncio.create_task(
-        background_update(
-            app,
-            {"update_interval": f"{app['update_info_interval']}"},
-            update_user_group_info,
+    if app["hubs"]:
+        app["hub_states"] = [_hub_state(app, hub) for hub in app["hubs"]]
+    else:
+        app["hub_session"] = client_session(
+            "hub",
+            headers=app["headers"],
+            connection_limit=app["hub_connection_limit"],
+            dns_cache_ttl=app["dns_cache_ttl"],
+            keepalive_timeout=app["keepalive_timeout"],
         )
+        app["hub_states"] = [app]
+    app["prometheus_session"] = client_session(
+        "prometheus",
+        connection_limit=app["prometheus_connection_limit"],
+        dns_cache_ttl=app["dns_cache_ttl"],
+        keepalive_timeout=app["keepalive_timeout"],
     )
+    logger.info("Client sessions started.")
+    USERNAMES.maxsize = app["username_cache_size"]
+    USER_TRACE.rate = app["user_trace_rate"]
+    SnapshotGauge.max_series = app["max_series_per_metric"]
+    if app["worker_pool"] == "thread":
+        app["executor"] = ThreadPoolExecutor(max_workers=app["worker_pool_size"])
+        app["join_executor"] = app["executor"]
+    elif app["worker_pool"] == "process":
+        app["executor"] = ProcessPoolExecutor(max_workers=app["worker_pool_size"])
+        # Pickling all user group maps for each usage join costs more than the join
+        app["join_executor"] = ThreadPoolExecutor(max_workers=app["worker_pool_size"])
+    else:
+        app["executor"] = None
+        app["join_executor"] = None
+    if app["executor"] is not None:
+        logger.info(
+            f"Decoding and joining in a {app['worker_pool']} pool of {app['worker_pool_size']} workers."
+        )
+    scheduler = Scheduler(
+        app,
+        adaptive=app["adaptive_intervals"],
+        max_interval_factor=app["max_interval_factor"],
+    )
+    for hub in app["hub_states"]:
+        restore_user_group_map(hub)
+        info_job = {
+            "update_interval": app["update_info_interval"],
+            "metric": USER_GROUP,
+            "backoff_when_unchanged": True,
+        }
+        if hub is not app:
+            info_job["hub"] = hub
+        scheduler.add_job(update_user_group_info, info_job)
     for cfg in CONFIG_COMPUTE:
-        cfg.update({"update_interval": f"{app['update_metrics_interval']}"})
-        app["task"] = asyncio.create_task(
-            background_update(app, dict(cfg), update_group_usage)
+        scheduler.add_job(
+            update_group_usage,
+            _usage_job(app, cfg, app["update_metrics_interval"]),
         )
     for cfg in CONFIG_DIRSIZE:
-        cfg.update({"update_interval": f"{app['update_dirsize_interval']}"})
-        app["task"] = asyncio.create_task(
-            background_update(app, dict(cfg), update_group_usage)
+        scheduler.add_job(
+            update_group_usage,
+            _usage_job(app, cfg, app["update_dirsize_interval"]),
         )
+    scheduler.start()
+    app["scheduler"] = scheduler
 
 
 async def on_cleanup(app):
-    await app["session"].close()
-    logger.info("Client session closed.")
+    await app["scheduler"].stop()
+    for executor in {app["executor"], app["join_executor"]} - {None}:
+        executor.shutdown(wait=False, cancel_futures=True)
+    for hub in app["hub_states"]:
+        await hub["hub_session"].close()
+    await app["prometheus_session"].close()
+    logger.info("Client sessions closed.")
 
 
 def sub_app(
     headers: str = None,
     hub_url: str = None,
+    hubs: list = None,
+    hub_api_concurrency: int = None,
+    hub_connection_limit: int = None,
     allowed_groups: list = None,
     double_count: str = None,
     namespace: str = None,
     jupyterhub_metrics_prefix: str = None,
     update_info_interval: int = None,
+    full_sync_interval: int = None,
+    snapshot_path: str = None,
+    push_token: str = None,
     update_metrics_interval: int = None,
     update_dirsize_interval: int = None,
+    adaptive_intervals: bool = None,
+    max_interval_factor: int = None,
     prometheus_host: str = None,
     prometheus_port: int = None,
+    prometheus_connection_limit: int = None,
+    dns_cache_ttl: int = None,
+    keepalive_timeout: float = None,
+    prometheus_query_mode: str = None,
+    prometheus_eval_offset: int = None,
+    prometheus_streaming: bool = None,
+    usage_aggregation: str = None,
+    label_profiles: dict = None,
+    max_series_per_metric: int = None,
+    user_trace_rate: int = None,
+    username_cache_size: int = None,
+    worker_pool: str = None,
+    worker_pool_size: int = None,
 ):
     app = web.Application()
     app["headers"] = headers
     app["hub_url"] = URL(hub_url)
+    app["hubs"] = hubs
+    app["hub_api_concurrency"] = hub_api_concurrency
+    app["hub_connection_limit"] = hub_connection_limit
     app["allowed_groups"] = allowed_groups
     app["double_count"] = double_count
     app["namespace"] = namespace
     app["jupyterhub_metrics_prefix"] = jupyterhub_metrics_prefix
     app["update_info_interval"] = update_info_interval
+    app["full_sync_interval"] = full_sync_interval
+    app["snapshot_path"] = snapshot_path
+    app["push_token"] = push_token
+    app["user_group_map_lock"] = asyncio.Lock()
     app["update_metrics_interval"] = update_metrics_interval
     app["update_dirsize_interval"] = update_dirsize_interval
+    app["adaptive_intervals"] = adaptive_intervals
+    app["max_interval_factor"] = max_interval_factor
     app["prometheus_host"] = prometheus_host
     app["prometheus_port"] = prometheus_port
+    app["prometheus_connection_limit"] = prometheus_connection_limit
+    app["dns_cache_ttl"] = dns_cache_ttl
+    app["keepalive_timeout"] = keepalive_timeout
+    app["prometheus_query_mode"] = prometheus_query_mode
+    app["prometheus_eval_offset"] = prometheus_eval_offset
+    app["prometheus_streaming"] = prometheus_streaming
+    app["usage_aggregation"] = usage_aggregation
+    app["label_profiles"] = label_profiles
+    app["max_series_per_metric"] = max_series_per_metric
+    app["user_trace_rate"] = user_trace_rate
+    app["username_cache_size"] = username_cache_size
+    app["worker_pool"] = worker_pool
+    app["worker_pool_size"] = worker_pool_size
     app.router.add_get("/", handle)
+    if push_token:
+        app.router.add_post("/memberships", handle_memberships)
     app.on_startup.append(on_startup)
     app.on_cleanup.append(on_cleanup)
     return app
@@ -120,6 +338,24 @@ def main():
         type=int,
         help="Time interval between each update of the user_group_info metric (seconds).",
     )
+    argparser.add_argument(
+        "--full_sync_interval",
+        default=0,
+        type=int,
+        help="Time interval between full resyncs of all hub users (seconds). In between, user_group_info is updated incrementally from hub group member lists. If 0, every update is a full resync.",
+    )
+    argparser.add_argument(
+        "--snapshot_path",
+        default=None,
+        type=str,
+        help="File to save the user group map to after each update of user_group_info. On startup, the map is loaded from this file and served until the first update has finished. If not provided, no snapshot is saved.",
+    )
+    argparser.add_argument(
+        "--push_token",
+        default=os.environ.get("GROUPS_EXPORTER_PUSH_TOKEN"),
+        type=str,
+        help="Token the hub must send to push group membership deltas to the memberships endpoint. If not provided, the endpoint is disabled and memberships are only polled from the JupyterHub API.",
+    )
     argparser.add_argument(
         "--update_metrics_interval",
         type=int,
@@ -130,6 +366,18 @@ def main():
         type=int,
         help="Time interval between each update of group home directory usage (seconds).",
     )
+    argparser.add_argument(
+        "--adaptive_intervals",
+        default="false",
+        type=_str_to_bool,
+        help="If 'true', back off user_group_info updates while memberships do not change, and lengthen the interval of any update that takes most of it.",
+    )
+    argparser.add_argument(
+        "--max_interval_factor",
+        default=4,
+        type=int,
+        help="Maximum factor by which adaptive intervals may exceed the configured update intervals.",
+    )
     argparser.add_argument(
         "--allowed_groups",
         nargs="*",
@@ -147,6 +395,24 @@ def main():
         type=str,
         help="JupyterHub service URL, e.g. http://localhost:8000 for local development.",
     )
+    argparser.add_argument(
+        "--hubs",
+        default=None,
+        type=_hubs,
+        help="JSON file listing the namespace, hub_url and api_token or api_token_env of each hub to export. If provided, one exporter serves all of these hubs and --hub_url, --hub_api_token and --jupyterhub_namespace are ignored.",
+    )
+    argparser.add_argument(
+        "--hub_api_concurrency",
+        default=8,
+        type=int,
+        help="Maximum number of concurrent page requests to the JupyterHub API.",
+    )
+    argparser.add_argument(
+        "--hub_connection_limit",
+        default=8,
+        type=int,
+        help="Maximum number of pooled connections to the JupyterHub API.",
+    )
     argparser.add_argument(
         "--hub_service_prefix",
         default=os.environ.get(
@@ -190,6 +456,87 @@ def main():
         type=int,
         help="Prometheus port.",
     )
+    argparser.add_argument(
+        "--prometheus_connection_limit",
+        default=8,
+        type=int,
+        help="Maximum number of pooled connections to Prometheus.",
+    )
+    argparser.add_argument(
+        "--dns_cache_ttl",
+        default=300,
+        type=int,
+        help="Cache DNS lookups of the JupyterHub and Prometheus hosts for this long (seconds).",
+    )
+    argparser.add_argument(
+        "--keepalive_timeout",
+        default=60,
+        type=float,
+        help="Keep idle connections to the JupyterHub and Prometheus APIs open for this long (seconds).",
+    )
+    argparser.add_argument(
+        "--prometheus_query_mode",
+        default="range",
+        choices=["instant", "range"],
+        type=str,
+        help="Query Prometheus usage with instant queries evaluated at a single timestamp, or with range queries over the last update_metrics_interval.",
+    )
+    argparser.add_argument(
+        "--prometheus_eval_offset",
+        default=0,
+        type=int,
+        help="Evaluate Prometheus queries this many seconds in the past, e.g. to allow for scrape delays (seconds).",
+    )
+    argparser.add_argument(
+        "--prometheus_streaming",
+        default="false",
+        type=_str_to_bool,
+        help="If 'true', parse Prometheus results incrementally as they are received and join each series with user groups as it is parsed, instead of decoding the whole response first.",
+    )
+    argparser.add_argument(
+        "--usage_aggregation",
+        default="user",
+        choices=["user", "group", "both"],
+        type=str,
+        help="Export usage per user and group, aggregated per group, or both.",
+    )
+    argparser.add_argument(
+        "--label_profile",
+        default="full",
+        type=_label_profiles,
+        help="Labels of the usage metrics: 'full', 'join_only' without the escaped usernames, or 'minimal' with only usergroup and username. Override it for individual metrics with comma-separated metric=profile entries.",
+    )
+    argparser.add_argument(
+        "--max_series_per_metric",
+        default=0,
+        type=int,
+        help="Maximum number of series exported per metric. Series over the limit are dropped and counted. If 0, there is no limit.",
+    )
+    argparser.add_argument(
+        "--username_cache_size",
+        default=100000,
+        type=int,
+        help="Maximum number of usernames to keep in the escaped username cache. Should exceed the number of hub users.",
+    )
+    argparser.add_argument(
+        "--worker_pool",
+        default="none",
+        choices=["none", "thread", "process"],
+        type=str,
+        help="Run JSON decoding and the user group join in a thread or process pool instead of on the event loop.",
+    )
+    argparser.add_argument(
+        "--worker_pool_size",
+        default=4,
+        type=int,
+        help="Number of workers in the worker pool.",
+    )
+    argparser.add_argument(
+        "--user_trace_rate",
+        default=0,
+        type=int,
+        help="Log per-user group memberships and join details at INFO level, at most this many lines per second. If 0, per-user logging is disabled.",
+    )
     argparser.add_argument(
         "--log_level",
         default="INFO",
@@ -218,6 +565,15 @@ def main():
             f"Double-count users with multiple group memberships: {args.double_count}"
         )
 
+    if args.hubs:
+        if "minimal" in args.label_profile.values():
+            argparser.error(
+                "the minimal label profile drops the namespace label and cannot be used with --hubs"
+            )
+        logger.info(
+            f"Exporting {len(args.hubs)} hubs in namespaces: {[hub['namespace'] for hub in args.hubs]}"
+        )
+
     if args.jupyterhub_metrics_prefix:
         os.environ["JUPYTERHUB_METRICS_PREFIX"] = args.jupyterhub_metrics_prefix
 
@@ -236,15 +592,36 @@ def main():
     metrics_app = sub_app(
         headers=headers,
         hub_url=args.hub_url,
+        hubs=args.hubs,
+        hub_api_concurrency=args.hub_api_concurrency,
+        hub_connection_limit=args.hub_connection_limit,
         allowed_groups=args.allowed_groups,
         double_count=args.double_count,
         namespace=args.jupyterhub_namespace,
         jupyterhub_metrics_prefix=args.jupyterhub_metrics_prefix,
         update_info_interval=args.update_info_interval,
+        full_sync_interval=args.full_sync_interval,
+        snapshot_path=args.snapshot_path,
+        push_token=args.push_token,
         update_metrics_interval=args.update_metrics_interval,
         update_dirsize_interval=args.update_dirsize_interval,
+        adaptive_intervals=args.adaptive_intervals,
+        max_interval_factor=args.max_interval_factor,
         prometheus_host=args.prometheus_host,
         prometheus_port=args.prometheus_port,
+        prometheus_connection_limit=args.prometheus_connection_limit,
+        dns_cache_ttl=args.dns_cache_ttl,
+        keepalive_timeout=args.keepalive_timeout,
+        prometheus_query_mode=args.prometheus_query_mode,
+        prometheus_eval_offset=args.prometheus_eval_offset,
+        prometheus_streaming=args.prometheus_streaming,
+        usage_aggregation=args.usage_aggregation,
+        label_profiles=args.label_profile,
+        max_series_per_metric=args.max_series_per_metric,
+        user_trace_rate=args.user_trace_rate,
+        username_cache_size=args.username_cache_size,
+        worker_pool=args.worker_pool,
+        worker_pool_size=args.worker_pool_size,
     )
     app.add_subapp(args.hub_service_prefix, metrics_app)
     web.run_app(app, port=args.port)
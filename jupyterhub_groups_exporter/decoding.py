@@ -0,0 +1,166 @@
+"""
+JSON decoding of JupyterHub and Prometheus API responses.
+
+The fastest available backend is used: msgspec, then orjson, then the standard
+library. With msgspec, responses are decoded against the models below, so only
+the fields the exporter reads are allocated and the rest are skipped.
+"""
+
+import codecs
+import json
+import re
+from typing import Any, NotRequired, TypedDict, Union
+
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+class HubUser(TypedDict, total=False):
+    kind: str
+    name: str
+    groups: list[str]
+
+
+class HubGroup(TypedDict, total=False):
+    kind: str
+    name: str
+    users: list[str]
+
+
+class Pagination(TypedDict):
+    offset: int
+    limit: int
+    total: int
+    next: NotRequired[Any]
+
+
+# Pages require their items, so that an error response cannot pass as an empty hub
+class HubUserPage(TypedDict):
+    items: list[HubUser]
+    _pagination: Pagination
+
+
+class HubGroupPage(TypedDict):
+    items: list[HubGroup]
+    _pagination: Pagination
+
+
+class PrometheusSeries(TypedDict, total=False):
+    metric: dict[str, str]
+    value: tuple[float, str]
+    values: list[tuple[float, str]]
+
+
+class PrometheusData(TypedDict, total=False):
+    resultType: str
+    result: list[PrometheusSeries]
+
+
+class PrometheusResponse(TypedDict, total=False):
+    status: str
+    data: PrometheusData
+    errorType: str
+    error: str
+
+
+# Models of the API endpoints, accepting non-paginated responses from older hubs
+HUB_USERS = Union[HubUserPage, list[HubUser]]
+HUB_GROUPS = Union[HubGroupPage, list[HubGroup]]
+
+if msgspec is not None:
+    BACKEND = "msgspec"
+elif orjson is not None:
+    BACKEND = "orjson"
+else:
+    BACKEND = "json"
+
+# Decoders are built lazily in each process, since msgspec decoders cannot be
+# pickled to the workers of a process pool.
+_decoders = {}
+
+
+def _decoder(model: type = None) -> callable:
+    if model not in _decoders:
+        if BACKEND == "msgspec":
+            decoder = msgspec.json.Decoder(model) if model else msgspec.json.Decoder()
+            _decoders[model] = decoder.decode
+        elif BACKEND == "orjson":
+            _decoders[model] = orjson.loads
+        else:
+            _decoders[model] = json.loads
+    return _decoders[model]
+
+
+def decode_json(body: bytes, model: type = None):
+    """
+    Decode a JSON response body into plain Python objects.
+
+    If a model is given and msgspec is installed, fields not in the model are
+    skipped. Other backends return the full document. All backends raise a
+    ValueError on invalid JSON.
+    """
+    return _decoder(model)(body)
+
+
+class PrometheusResultParser:
+    """
+    Incrementally parse the series of a Prometheus query response.
+
+    Chunks of the response body are fed as they arrive and the complete series
+    of the result array parsed so far are returned, so only the unparsed
+    remainder of the body is held in memory. Everything around the result array
+    is kept and decoded on close, with an empty result.
+    """
+
+    _result_start = re.compile(r'"result"\s*:\s*\[')
+    _separator = re.compile(r"[\s,]*")
+
+    def __init__(self):
+        self._text = codecs.getincrementaldecoder("utf-8")()
+        self._scanner = json.JSONDecoder()
+        self._buffer = ""
+        self._head = ""
+        self._state = "head"
+
+    def feed(self, chunk: bytes) -> list:
+        self._buffer += self._text.decode(chunk)
+        series = []
+        if self._state == "head":
+            match = self._result_start.search(self._buffer)
+            if match is None:
+                return series
+            self._head = self._buffer[: match.end()]
+            self._buffer = self._buffer[match.end() :]
+            self._state = "result"
+        if self._state == "result":
+            pos = 0
+            while True:
+                pos = self._separator.match(self._buffer, pos).end()
+                if pos == len(self._buffer):
+                    break
+                if self._buffer[pos] == "]":
+                    self._state = "tail"
+                    break
+                try:
+                    value, pos = self._scanner.raw_decode(self._buffer, pos)
+                except json.JSONDecodeError:
+                    # Wait for the rest of the series
+                    break
+                series.append(value)
+            self._buffer = self._buffer[pos:]
+        return series
+
+    def close(self) -> dict:
+        self._buffer += self._text.decode(b"", final=True)
+        if self._state == "result":
+            raise ValueError(
+                f"Invalid or truncated Prometheus result: {self._buffer[:100]}"
+            )
+        return json.loads(self._head + self._buffer)
@@ -0,0 +1,162 @@
+"""
+Cached rendering of the Prometheus exposition served by the metrics endpoint.
+"""
+
+import logging
+import zlib
+
+from prometheus_client import REGISTRY, generate_latest
+from prometheus_client.exposition import choose_encoder
+from prometheus_client.registry import CollectorRegistry
+
+from .metrics import EXPORTER_REGISTRY
+
+try:
+    from compression import zstd  # Python >= 3.14
+except ImportError:
+    try:
+        import zstandard as zstd
+    except ImportError:
+        zstd = None
+
+logger = logging.getLogger(__name__)
+
+OPENMETRICS_EOF = b"# EOF\n"
+
+
+class _Identity:
+    def __init__(self, data: bytes):
+        self.head = data
+
+    def finish(self, tail: bytes) -> bytes:
+        return self.head + tail
+
+
+class _Gzip:
+    """
+    Keep the compressor state after the cached body, so that each scrape only
+    compresses the live tail into the same gzip member.
+    """
+
+    def __init__(self, data: bytes):
+        self._compressor = zlib.compressobj(6, zlib.DEFLATED, zlib.MAX_WBITS | 16)
+        self.head = self._compressor.compress(data)
+
+    def finish(self, tail: bytes) -> bytes:
+        compressor = self._compressor.copy()
+        return self.head + compressor.compress(tail) + compressor.flush()
+
+
+class _Zstd:
+    """
+    Zstandard decoders must accept concatenated frames, so the live tail is
+    compressed as a second frame after the cached body.
+    """
+
+    def __init__(self, data: bytes):
+        self.head = zstd.compress(data)
+
+    def finish(self, tail: bytes) -> bytes:
+        return self.head + zstd.compress(tail)
+
+
+# Supported content codings, in order of preference.
+CODINGS = {}
+if zstd is not None:
+    CODINGS["zstd"] = _Zstd
+CODINGS["gzip"] = _Gzip
+
+
+def negotiate_encoding(accept_encoding: str = None) -> str:
+    """
+    Pick the preferred supported content coding from an Accept-Encoding header.
+    """
+    accepted = {}
+    for token in (accept_encoding or "").split(","):
+        coding, _, params = token.partition(";")
+        quality = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0.0
+        accepted[coding.strip().lower()] = quality
+    encoding, quality = "identity", 0.0
+    for coding in CODINGS:
+        if accepted.get(coding, 0.0) > quality:
+            encoding, quality = coding, accepted[coding]
+    return encoding
+
+
+class CachedExposition:
+    """
+    Render a registry at most once per generation and serve the cached bytes.
+
+    The generation is bumped by the update coroutines whenever they publish new
+    samples, so scrapes in between are served straight from memory. Each
+    exposition format and content coding is cached separately, and a small
+    live tail can be appended to the cached body at scrape time.
+    """
+
+    def __init__(self, registry: CollectorRegistry):
+        self.registry = registry
+        self.generation = 0
+        self._cache = {}
+        self._cache_generation = 0
+
+    def invalidate(self):
+        self.generation += 1
+
+    def _cached(self, key: tuple, factory: callable):
+        if self._cache_generation != self.generation:
+            self._cache = {}
+            self._cache_generation = self.generation
+        if key not in self._cache:
+            self._cache[key] = factory()
+        return self._cache[key]
+
+    def _body(self, encoder: callable, content_type: str) -> bytes:
+        def factory():
+            body = encoder(self.registry)
+            # The OpenMetrics terminator is added back by the live tail
+            if body.endswith(OPENMETRICS_EOF):
+                body = body[: -len(OPENMETRICS_EOF)]
+            logger.debug(
+                f"Rendered exposition for generation {self.generation} as {content_type} ({len(body)} bytes)."
+            )
+            return body
+
+        return self._cached((content_type, None), factory)
+
+    def render(
+        self,
+        encoder: callable = generate_latest,
+        content_type: str = None,
+        encoding: str = "identity",
+        tail: bytes = b"",
+    ) -> bytes:
+        coding = self._cached(
+            (content_type, encoding),
+            lambda: CODINGS.get(encoding, _Identity)(self._body(encoder, content_type)),
+        )
+        return coding.finish(tail)
+
+
+EXPOSITION = CachedExposition(EXPORTER_REGISTRY)
+
+
+def render_metrics(accept: str = None, accept_encoding: str = None):
+    """
+    Return the exposition body and response headers for a scrape.
+
+    Process and runtime metrics from the default registry are cheap and change
+    continuously, so they are rendered on every scrape after the cached body.
+    """
+    encoder, content_type = choose_encoder(accept)
+    encoding = negotiate_encoding(accept_encoding)
+    headers = {"Content-Type": content_type, "Vary": "Accept, Accept-Encoding"}
+    if encoding != "identity":
+        headers["Content-Encoding"] = encoding
+    body = EXPOSITION.render(encoder, content_type, encoding, tail=encoder(REGISTRY))
+    return body, headers
@@ -1,7 +1,11 @@
-import copy
+import asyncio
+import itertools
 import logging
 import string
-from collections import Counter
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Executor
 from datetime import datetime, timedelta
 
 import aiohttp
@@ -10,23 +14,172 @@ import escapism
 from aiohttp import web
 from yarl import URL
 
+from .decoding import (
+    HUB_GROUPS,
+    HUB_USERS,
+    PrometheusResponse,
+    PrometheusResultParser,
+    decode_json,
+)
+from .exposition import EXPOSITION
 from .kubespawner_slugs import safe_slug
-from .metrics import USER_GROUP
+from .metrics import (
+    FETCH_RETRIES,
+    LABEL_PROFILES,
+    MEMBERSHIP_DELTAS,
+    USER_GROUP,
+    USER_GROUP_MAP_STALE,
+    USERNAME_CACHE_HITS,
+    USERNAME_CACHE_MISSES,
+)
+from .singleflight import single_flight
+from .snapshot import load_snapshot, save_snapshot
 
 logger = logging.getLogger(__name__)
 
+# Fields of the hub user model returned when the exporter is only granted the
+# list:users and read:users:groups scopes.
+USER_MEMBERSHIP_FIELDS = {"kind", "name", "admin", "user_info", "groups"}
 
-@backoff.on_exception(backoff.expo, aiohttp.ClientError, max_tries=12, logger=logger)
+# Maximum size of the response chunks read when streaming Prometheus results.
+STREAM_CHUNK_SIZE = 2**16
+
+
+def _count_retry(details: dict):
+    FETCH_RETRIES.labels(function=details["target"].__name__).inc()
+
+
+async def run_in_executor(executor: Executor, func: callable, *args):
+    """
+    Run a CPU-bound function in a worker pool, or inline if there is none.
+    """
+    if executor is None:
+        return func(*args)
+    return await asyncio.get_running_loop().run_in_executor(executor, func, *args)
+
+
+def _fetch_key(
+    session: aiohttp.ClientSession,
+    url: URL,
+    path: str = False,
+    params: dict = None,
+    executor: Executor = None,
+    model: type = None,
+) -> tuple:
+    url = url / path if path else url
+    return (id(session), str(url), tuple(sorted((params or {}).items())), model)
+
+
+def _hub_key(app: web.Application, config: dict = None) -> int:
+    return id(config.get("hub", app) if config else app)
+
+
+def _usage_key(app: web.Application, config: dict) -> tuple:
+    return (id(app), config["metric"].name)
+
+
+@single_flight(_fetch_key)
+@backoff.on_exception(
+    backoff.expo,
+    aiohttp.ClientError,
+    max_tries=12,
+    logger=logger,
+    on_backoff=_count_retry,
+)
 async def fetch_page(
-    session: aiohttp.ClientSession, url: URL, path: str = False, params: dict = None
+    session: aiohttp.ClientSession,
+    url: URL,
+    path: str = False,
+    params: dict = None,
+    executor: Executor = None,
+    model: type = None,
 ):
     """
     Fetch a page from the JupyterHub API.
+
+    The body is decoded with the fastest available JSON backend against the
+    model of the response, in the worker pool if one is given. Concurrent
+    fetches of the same URL and parameters share one request and its decoded
+    result, which callers must not modify. Error statuses raise a
+    ClientResponseError, so they are retried rather than decoded as data.
     """
     url = url / path if path else url
     logger.debug(f"Fetching {url}")
     async with session.get(url, params=params) as response:
-        return await response.json()
+        response.raise_for_status()
+        body = await response.read()
+        if "json" not in response.content_type:
+            raise aiohttp.ContentTypeError(
+                response.request_info,
+                response.history,
+                status=response.status,
+                message=f"Attempt to decode JSON with unexpected mimetype: {response.content_type}",
+                headers=response.headers,
+            )
+    return await run_in_executor(executor, decode_json, body, model)
+
+
+def _check_page(data, path: str):
+    """
+    Raise a ValueError unless data is a page of a paginated hub API response.
+
+    Decoders other than msgspec do not validate the page, and a response
+    without items must not pass as an empty hub.
+    """
+    if (
+        not isinstance(data, dict)
+        or not isinstance(data.get("items"), list)
+        or not isinstance(data.get("_pagination"), dict)
+    ):
+        raise ValueError(f"Unexpected response from {path}: not a page of items.")
+
+
+async def fetch_paginated(
+    session: aiohttp.ClientSession,
+    url: URL,
+    path: str,
+    semaphore: asyncio.Semaphore,
+    executor: Executor = None,
+    model: type = None,
+):
+    """
+    Fetch all items from a paginated JupyterHub API endpoint.
+
+    The first page tells us the total number of items and the page size the hub
+    allows, so the remaining offset/limit windows are fetched concurrently instead
+    of following the next links one page at a time.
+    """
+    async with semaphore:
+        data = await fetch_page(session, url, path, executor=executor, model=model)
+    if isinstance(data, list):
+        logger.debug("Received non-paginated data.")
+        return data
+    _check_page(data, path)
+    pagination = data["_pagination"]
+    logger.debug(f"Received paginated data: {pagination}")
+    items = list(data["items"])
+    limit = pagination["limit"] or len(items)
+    if not limit:
+        return items
+
+    async def fetch_window(offset: int):
+        async with semaphore:
+            page = await fetch_page(
+                session,
+                url,
+                path,
+                params={"offset": offset, "limit": limit},
+                executor=executor,
+                model=model,
+            )
+        _check_page(page, path)
+        return page["items"]
+
+    offsets = range(pagination["offset"] + len(items), pagination["total"], limit)
+    pages = await asyncio.gather(*(fetch_window(offset) for offset in offsets))
+    for page in pages:
+        items.extend(page)
+    return items
 
 
 def _escape_username(username: str) -> str:
@@ -50,158 +203,725 @@ def _escape_username_safe(username: str) -> str:
     return safe_slug(username, max_length=_slug_max_length)
 
 
+class UsernameCache:
+    """
+    Bounded LRU cache mapping a username to its escaped and safe variants.
+
+    Escaping is comparatively expensive and usernames rarely change between
+    cycles, so the cache is warmed when the hub user list is refreshed and
+    shared by every gauge. It is guarded by a lock, as joins of several
+    metrics may use it concurrently from a thread pool.
+    """
+
+    def __init__(self, maxsize: int = 100000):
+        self.maxsize = maxsize
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._cache)
+
+    def get(self, username: str) -> tuple:
+        """
+        Return the (username_escaped, username_safe) pair for a username.
+        """
+        with self._lock:
+            escaped = self._cache.get(username)
+            if escaped is not None:
+                self._cache.move_to_end(username)
+        if escaped is not None:
+            USERNAME_CACHE_HITS.inc()
+            return escaped
+        USERNAME_CACHE_MISSES.inc()
+        escaped = (_escape_username(username), _escape_username_safe(username))
+        with self._lock:
+            self._cache[username] = escaped
+            while len(self._cache) > self.maxsize:
+                self._cache.popitem(last=False)
+        return escaped
+
+    def items(self) -> list:
+        """
+        Return the cached (username, (username_escaped, username_safe)) pairs.
+        """
+        with self._lock:
+            return list(self._cache.items())
+
+    def update(self, usernames: dict):
+        """
+        Warm the cache with escaped usernames, e.g. from a snapshot.
+        """
+        with self._lock:
+            self._cache.update(usernames)
+            while len(self._cache) > self.maxsize:
+                self._cache.popitem(last=False)
+
+
+USERNAMES = UsernameCache()
+
+
+class UserTrace:
+    """
+    Rate-limited log of per-user details, such as group memberships and users
+    without groups.
+
+    Logging every user each cycle floods the logs of large hubs, so at most
+    `rate` messages are logged per second and the rest are counted and
+    summarised. Callers should check `enabled` before formatting a message.
+    """
+
+    def __init__(self, rate: int = 0):
+        self.rate = rate
+        self._window = 0
+        self._logged = 0
+        self._suppressed = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.rate > 0 and logger.isEnabledFor(logging.INFO)
+
+    def log(self, message: str):
+        now = time.monotonic()
+        if now - self._window >= 1:
+            if self._suppressed:
+                logger.info(f"Suppressed {self._suppressed} user trace messages.")
+            self._window = now
+            self._logged = 0
+            self._suppressed = 0
+        if self._logged < self.rate:
+            self._logged += 1
+            logger.info(message)
+        else:
+            self._suppressed += 1
+
+
+USER_TRACE = UserTrace()
+
+
+def _examples(items, n: int = 5) -> str:
+    """
+    Summarise a collection by a few of its items for logging.
+    """
+    examples = ", ".join(str(item) for item in itertools.islice(items, n))
+    return f"{examples}, ..." if len(items) > n else examples
+
+
+def _users_from_groups(groups: list, known_users: dict) -> list:
+    """
+    Rebuild user models from the member lists of hub groups.
+
+    Users who are not a member of any group are carried over from the previous
+    sync, so they keep being exported until the next full resync. Duplicate
+    group records, which can appear when pages shift during a concurrent fetch,
+    are ignored.
+    """
+    user_groups = {user: [] for user in known_users}
+    unique_groups = {group["name"]: group for group in groups}
+    for group in unique_groups.values():
+        for user in dict.fromkeys(group.get("users", [])):
+            user_groups.setdefault(user, []).append(group["name"])
+    return [
+        {"kind": "user", "name": user, "groups": groups}
+        for user, groups in user_groups.items()
+    ]
+
+
+def _build_user_group_map(users: list, allowed_groups: list):
+    """
+    Map each user to their groups in a single pass over the hub user models.
+
+    Users who are not in any allowed group are mapped to 'none', and users in
+    more than one allowed group are also added to the default group 'multiple'.
+    Returns the map and the set of users in multiple groups.
+    """
+    allowed = set(allowed_groups)
+    user_to_groups = {}
+    users_in_multiple_groups = set()
+    trace = USER_TRACE.enabled
+    for r in users:
+        user = r["name"]
+        if r["kind"] != "user" or user in user_to_groups:
+            continue
+        n_allowed = sum(1 for group in r["groups"] if not allowed or group in allowed)
+        if n_allowed == 0:
+            if trace:
+                USER_TRACE.log(f"User {user} has no groups.")
+            user_to_groups[user] = ["none"]
+        elif n_allowed == 1:
+            user_to_groups[user] = list(r["groups"])
+        else:
+            user_to_groups[user] = [*r["groups"], "multiple"]
+            users_in_multiple_groups.add(user)
+    return user_to_groups, users_in_multiple_groups
+
+
+def _user_group_keys(namespace: str, user: str, groups: list, double_count: bool):
+    """
+    Yield the label values of the user_group_info samples for a user.
+    """
+    username_escaped, username_safe = USERNAMES.get(user)
+    if "multiple" in groups and double_count == False:
+        groups = ["multiple"]
+    for group in groups:
+        yield (f"{namespace}", group, user, username_escaped, username_safe)
+
+
+def _changed_users(previous: dict, current: dict) -> set:
+    """
+    Return the users whose group memberships differ between two user group maps.
+    """
+    return {
+        user
+        for user in previous.keys() | current.keys()
+        if user not in previous
+        or user not in current
+        or set(previous[user]) != set(current[user])
+    }
+
+
+def _user_group_samples(
+    namespace: str,
+    previous: dict,
+    current: dict,
+    published: dict,
+    double_count: bool,
+):
+    """
+    Compute the user_group_info samples for a new user group map.
+
+    All users are exported on the first sync, replacing any samples published
+    for the namespace, e.g. from a snapshot. Afterwards only the samples of
+    users whose memberships changed are replaced in the published samples.
+    Returns the samples and the users that changed.
+    """
+    if previous is None:
+        changed = set(current)
+        samples = {
+            key: value
+            for key, value in (published or {}).items()
+            if key[0] != f"{namespace}"
+        }
+    else:
+        changed = _changed_users(previous, current)
+        samples = published
+        logger.info(f"Group memberships changed for {len(changed)} users.")
+    trace = USER_TRACE.enabled
+    for user in changed:
+        if previous is not None and user in previous:
+            for key in _user_group_keys(namespace, user, previous[user], double_count):
+                samples.pop(key, None)
+        if user in current:
+            for key in _user_group_keys(namespace, user, current[user], double_count):
+                samples[key] = 1
+                if trace:
+                    USER_TRACE.log(f"User {user} is in group {key[1]}.")
+    return samples, changed
+
+
+async def _check_user_model_fields(session: aiohttp.ClientSession, hub_url: URL):
+    """
+    Warn if the hub returns user model fields the exporter does not need.
+
+    Typed decoding skips unknown fields, so a single user is fetched and decoded
+    without a model to see the fields granted by the token's scopes.
+    """
+    data = await fetch_page(session, hub_url, "hub/api/users", params={"limit": 1})
+    users = data if isinstance(data, list) else data.get("items", [])
+    extra_fields = set(users[0]) - USER_MEMBERSHIP_FIELDS if users else set()
+    if extra_fields:
+        logger.warning(
+            f"Hub user models include fields not needed by the exporter: {sorted(extra_fields)}. "
+            "Grant only the list:users and read:users:groups scopes to shrink them."
+        )
+
+
+def _save_user_group_map(path: str, user_to_groups: dict):
+    """
+    Save a snapshot of the user group map and the escaped names of its users.
+
+    The escaped names are looked up in this process, as the username cache of
+    worker processes is not shared with it.
+    """
+    usernames = {user: USERNAMES.get(user) for user in user_to_groups}
+    save_snapshot(path, user_to_groups, usernames)
+
+
+@single_flight(_hub_key)
 async def update_user_group_info(
     app: web.Application,
     config: dict = None,
 ):
     """
     Update the prometheus exporter with user group memberships fetched from the JupyterHub API.
+
+    In multi-hub mode, the job config holds the state of the hub to update.
+    A call while an update of the same hub is running waits for that update.
+    Returns the number of users whose memberships changed.
     """
     logger.info("This is the update_user_group_info coroutine.")
-    session = app["session"]
-    hub_url = app["hub_url"]
-    allowed_groups = app["allowed_groups"]
-    double_count = app["double_count"]
-    namespace = app["namespace"]
-    endpoints = ["hub/api/users", "hub/api/groups"]
-    results = []
-    for i in range(len(endpoints)):
-        endpoint = endpoints[i]
-        data = await fetch_page(session, hub_url, endpoint)
-        if "_pagination" in data:
-            logger.debug(f"Received paginated data: {data['_pagination']}")
-            items = data["items"]
-            next_info = data["_pagination"]["next"]
-            while next_info:
-                data = await fetch_page(session, next_info["url"])
-                next_info = data["_pagination"]["next"]
-                items.extend(data["items"])
+    hub = config.get("hub", app) if config else app
+    session = hub["hub_session"]
+    hub_url = hub["hub_url"]
+    allowed_groups = hub["allowed_groups"]
+    double_count = hub["double_count"]
+    namespace = hub["namespace"]
+    previous = hub.get("user_group_map")
+    full_sync_interval = hub["full_sync_interval"]
+    last_full_sync = hub.get("last_full_sync")
+    full_sync = (
+        not full_sync_interval
+        or previous is None
+        or last_full_sync is None
+        or time.monotonic() - last_full_sync >= full_sync_interval
+    )
+    executor = hub.get("executor")
+    semaphore = asyncio.Semaphore(hub["hub_api_concurrency"])
+    if full_sync:
+        users, groups = await asyncio.gather(
+            fetch_paginated(
+                session, hub_url, "hub/api/users", semaphore, executor, HUB_USERS
+            ),
+            fetch_paginated(
+                session, hub_url, "hub/api/groups", semaphore, executor, HUB_GROUPS
+            ),
+        )
+        if not hub.get("user_model_checked"):
+            await _check_user_model_fields(session, hub_url)
+            hub["user_model_checked"] = True
+    else:
+        logger.info("Incremental sync of user group memberships from hub groups.")
+        groups = await fetch_paginated(
+            session, hub_url, "hub/api/groups", semaphore, executor, HUB_GROUPS
+        )
+        users = _users_from_groups(groups, previous)
+    user_to_groups, users_in_multiple_groups = await run_in_executor(
+        executor, _build_user_group_map, users, allowed_groups
+    )
+    allowed = set(allowed_groups)
+    list_groups = [g["name"] for g in groups if not allowed or g["name"] in allowed]
+    n_users = sum(1 for groups in user_to_groups.values() if groups != ["none"])
+    logger.info(
+        f"Updating {len(list_groups)} groups and {n_users} users for metric user_group_info."
+    )
+    if users_in_multiple_groups:
+        logger.info(
+            f"{len(users_in_multiple_groups)} users are in multiple groups and also assigned to default group 'multiple', "
+            f"for example: {_examples(users_in_multiple_groups)}"
+        )
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(f"List groups: {list_groups}")
+        logger.debug(f"Users in multiple groups: {users_in_multiple_groups}")
+        logger.debug(f"User to groups mapping: {user_to_groups}")
+    # Diff against the latest map, which membership deltas may have changed
+    async with hub["user_group_map_lock"]:
+        previous = hub.get("user_group_map")
+        samples, changed = await run_in_executor(
+            executor,
+            _user_group_samples,
+            namespace,
+            previous,
+            user_to_groups,
+            dict(USER_GROUP.samples),
+            double_count,
+        )
+        if changed:
+            USER_GROUP.publish(samples)
+            EXPOSITION.invalidate()
+        hub["user_group_map"] = user_to_groups
+    if full_sync:
+        hub["last_full_sync"] = time.monotonic()
+    snapshot_path = hub.get("snapshot_path")
+    if snapshot_path and (changed or hub.get("user_group_map_stale")):
+        try:
+            await asyncio.to_thread(_save_user_group_map, snapshot_path, user_to_groups)
+        except OSError as e:
+            logger.warning(f"Failed to save user group map snapshot: {e}")
         else:
-            logger.debug("Received non-paginated data.")
-            items = data
-        results.extend(items)
-    list_groups = []
-    list_users = []
-    for r in results:
-        if r["kind"] == "group" and (
-            r["name"] in allowed_groups or allowed_groups == []
-        ):
-            list_groups.append(r["name"])
-        elif r["kind"] == "user":
-            for group in r["groups"]:
-                if group in allowed_groups or allowed_groups == []:
-                    list_users.append(r["name"])
-    user_counts = Counter(list_users)
-    users_in_multiple_groups = [
-        user for user, count in user_counts.items() if count > 1
+            logger.info(f"Saved user group map snapshot to {snapshot_path}.")
+    if hub.get("user_group_map_stale"):
+        logger.info("Replaced the user group map snapshot with live data.")
+    hub["user_group_map_stale"] = False
+    USER_GROUP_MAP_STALE.labels(namespace=f"{namespace}").set(0)
+    return len(changed)
+
+
+def _apply_membership_deltas(
+    user_group_map: dict, deltas: list, allowed_groups: list
+) -> dict:
+    """
+    Return the entries of a user group map changed by membership deltas.
+
+    Each delta adds a user to or removes a user from a group, sets all groups
+    of a user, or deletes a user. Deleted users are mapped to None. Raises a
+    ValueError on an invalid delta.
+    """
+    hub_groups = {}
+    for delta in deltas:
+        if not isinstance(delta, dict) or not isinstance(delta.get("user"), str):
+            raise ValueError(f"Invalid membership delta: {delta}")
+        user = delta["user"]
+        action = delta.get("action")
+        if user not in hub_groups:
+            hub_groups[user] = [
+                group
+                for group in user_group_map.get(user, [])
+                if group not in ("none", "multiple")
+            ]
+        groups = hub_groups[user] or []
+        if action == "add" and isinstance(delta.get("group"), str):
+            if delta["group"] not in groups:
+                hub_groups[user] = [*groups, delta["group"]]
+        elif action == "remove" and isinstance(delta.get("group"), str):
+            if hub_groups[user] is not None:
+                hub_groups[user] = [g for g in groups if g != delta["group"]]
+        elif action == "set" and isinstance(delta.get("groups"), list):
+            hub_groups[user] = list(dict.fromkeys(delta["groups"]))
+        elif action == "delete":
+            hub_groups[user] = None
+        else:
+            raise ValueError(f"Invalid membership delta: {delta}")
+    users = [
+        {"kind": "user", "name": user, "groups": groups}
+        for user, groups in hub_groups.items()
+        if groups is not None
     ]
-    unique_users = list(set(list_users))
-    logger.debug(f"List groups: {list_groups}")
-    logger.debug(f"List users: {list_users}")
-    logger.debug(f"Users in multiple groups: {users_in_multiple_groups}")
+    entries, _ = _build_user_group_map(users, allowed_groups)
+    for user, groups in hub_groups.items():
+        if groups is None:
+            entries[user] = None
+    return entries
+
+
+async def apply_membership_deltas(app: web.Application, deltas: list) -> int:
+    """
+    Apply membership deltas pushed by the hub to the live user group map.
+
+    Only the user_group_info samples of the users in the deltas are replaced.
+    Returns the number of users whose memberships changed, or None if the map
+    has not been initialized yet, in which case the first sync with the hub
+    picks up the changes.
+    """
+    async with app["user_group_map_lock"]:
+        current = app.get("user_group_map")
+        if current is None:
+            return None
+        entries = _apply_membership_deltas(current, deltas, app["allowed_groups"])
+        previous = {user: current[user] for user in entries if user in current}
+        updated = {user: groups for user, groups in entries.items() if groups}
+        samples, changed = _user_group_samples(
+            app["namespace"],
+            previous,
+            updated,
+            dict(USER_GROUP.samples),
+            app["double_count"],
+        )
+        for delta in deltas:
+            MEMBERSHIP_DELTAS.labels(action=delta["action"]).inc()
+        if changed:
+            USER_GROUP.publish(samples)
+            EXPOSITION.invalidate()
+            user_group_map = dict(current)
+            for user, groups in entries.items():
+                if groups:
+                    user_group_map[user] = groups
+                else:
+                    user_group_map.pop(user, None)
+            app["user_group_map"] = user_group_map
+    return len(changed)
+
+
+def restore_user_group_map(app: web.Application):
+    """
+    Load the user group map from a snapshot saved by a previous run.
+
+    The map is served immediately and marked stale until the first sync with
+    the hub replaces it. A missing or invalid snapshot is skipped.
+    """
+    snapshot_path = app.get("snapshot_path")
+    if not snapshot_path:
+        return
+    try:
+        user_to_groups, usernames, saved = load_snapshot(snapshot_path)
+    except FileNotFoundError:
+        logger.info(f"No user group map snapshot at {snapshot_path}.")
+        return
+    except (OSError, ValueError) as e:
+        logger.warning(f"Ignoring user group map snapshot: {e}")
+        return
+    USERNAMES.update(usernames)
+    samples, _ = _user_group_samples(
+        app["namespace"],
+        None,
+        user_to_groups,
+        dict(USER_GROUP.samples),
+        app["double_count"],
+    )
+    USER_GROUP.publish(samples)
+    EXPOSITION.invalidate()
+    app["user_group_map"] = user_to_groups
+    app["user_group_map_stale"] = True
+    USER_GROUP_MAP_STALE.labels(namespace=f"{app['namespace']}").set(1)
     logger.info(
-        f"Updating {len(list_groups)} groups and {len(unique_users)} users for metric user_group_info."
+        f"Loaded user group map of {len(user_to_groups)} users from a snapshot saved "
+        f"{time.time() - saved:.0f} seconds ago, pending the first sync with the hub."
     )
-    user_to_groups = {}
+
+
+def _join_user_groups(results: list, user_group_map: dict):
+    """
+    Join Prometheus series with user group memberships.
+
+    Yields a (username, usergroup, value) tuple for every group of each user,
+    reading only the last sample of each series instead of copying it. Both
+    instant vectors and range matrices are accepted.
+    """
+    trace = USER_TRACE.enabled
     for r in results:
-        user = r["name"]
-        if r["kind"] == "user" and user in unique_users:
-            if r["groups"] != []:
-                for group in r["groups"]:
-                    user_to_groups.setdefault(user, []).append(group)
-        elif r["kind"] == "user":
-            logger.debug(f"User {user} has no groups.")
-            user_to_groups.setdefault(user, ["none"])
-    logger.debug(f"User to groups mapping: {user_to_groups}")
-    # Loop over users to export
-    USER_GROUP.clear()
-    for user in list(user_to_groups.keys()):
-        if user in users_in_multiple_groups:
-            user_to_groups[user].append("multiple")
-            USER_GROUP.labels(
-                namespace=f"{namespace}",
-                usergroup="multiple",
-                username=f"{user}",
-                username_escaped=_escape_username(user),
-                username_safe=_escape_username_safe(user),
-            ).set(1)
-            logger.info(
-                f"User {user} is in multiple groups: assigning to default group 'multiple'."
+        username = r["metric"]["username"]
+        sample = r["value"] if "value" in r else r["values"][-1]
+        value = float(sample[-1])
+        groups = user_group_map.get(username)
+        if not groups:
+            if trace:
+                USER_TRACE.log(f"User {username} has no groups, assigning to 'none'.")
+            yield username, "none", value
+            continue
+        for group in groups:
+            yield username, group, value
+
+
+def _full_labels(namespace: str, usergroup: str, username: str) -> tuple:
+    return (f"{namespace}", usergroup, username, *USERNAMES.get(username))
+
+
+def _join_only_labels(namespace: str, usergroup: str, username: str) -> tuple:
+    return (f"{namespace}", usergroup, username)
+
+
+def _minimal_labels(namespace: str, usergroup: str, username: str) -> tuple:
+    return (usergroup, username)
+
+
+# Label values of the usage gauges for each label profile in LABEL_PROFILES
+LABEL_VALUES = {
+    "full": _full_labels,
+    "join_only": _join_only_labels,
+    "minimal": _minimal_labels,
+}
+
+
+def _add_group_usage_samples(
+    samples: dict,
+    namespace: str,
+    results: list,
+    user_group_map: dict,
+    label_profile: str = "full",
+):
+    """
+    Add the samples of a group usage gauge for a batch of Prometheus results.
+    """
+    label_values = LABEL_VALUES[label_profile]
+    for username, usergroup, value in _join_user_groups(results, user_group_map):
+        samples[label_values(namespace, usergroup, username)] = value
+    return samples
+
+
+def _hub_usage_samples(
+    samples: dict, results: list, user_group_maps: dict, label_profile: str = "full"
+):
+    """
+    Add the samples of a group usage gauge for Prometheus results of many hubs.
+
+    Each series is joined with the user group map of the hub in its namespace
+    label. Series of hubs whose user group map is not initialized are skipped.
+    """
+    by_namespace = {}
+    for r in results:
+        by_namespace.setdefault(r["metric"].get("namespace"), []).append(r)
+    for namespace, series in by_namespace.items():
+        user_group_map = user_group_maps.get(namespace)
+        if user_group_map:
+            _add_group_usage_samples(
+                samples, namespace, series, user_group_map, label_profile
             )
-            if double_count == False:
-                continue
-        for group in user_to_groups[user]:
-            USER_GROUP.labels(
-                namespace=f"{namespace}",
-                usergroup=f"{group}",
-                username=f"{user}",
-                username_escaped=_escape_username(user),
-                username_safe=_escape_username_safe(user),
-            ).set(1)
-            logger.info(f"User {user} is in group {group}.")
-    app["user_group_map"] = user_to_groups
+    return samples
+
 
+def _aggregate_group_samples(
+    samples: dict, namespace: str, label_profile: str = "full"
+) -> dict:
+    """
+    Aggregate the samples of a group usage gauge over the users of each group.
 
+    Groups are keyed by the namespace label of the samples, or by the given
+    namespace for label profiles without one.
+    """
+    labelnames = LABEL_PROFILES[label_profile]
+    usergroup_index = labelnames.index("usergroup")
+    namespace_index = (
+        labelnames.index("namespace") if "namespace" in labelnames else None
+    )
+    totals = {}
+    for labelvalues, value in samples.items():
+        if namespace_index is None:
+            key = (f"{namespace}", labelvalues[usergroup_index])
+        else:
+            key = (labelvalues[namespace_index], labelvalues[usergroup_index])
+        total = totals.get(key)
+        if total is None:
+            totals[key] = [value, value, 1]
+        else:
+            total[0] += value
+            total[1] = max(total[1], value)
+            total[2] += 1
+    aggregated = {}
+    for (group_namespace, usergroup), (total, maximum, count) in totals.items():
+        aggregated[(group_namespace, usergroup, "sum")] = total
+        aggregated[(group_namespace, usergroup, "max")] = maximum
+        aggregated[(group_namespace, usergroup, "count")] = count
+    return aggregated
+
+
+@backoff.on_exception(
+    backoff.expo,
+    aiohttp.ClientError,
+    max_tries=12,
+    logger=logger,
+    on_backoff=_count_retry,
+)
+async def stream_group_usage_samples(
+    session: aiohttp.ClientSession,
+    url: URL,
+    path: str,
+    params: dict,
+    user_group_maps: dict,
+    label_profile: str = "full",
+):
+    """
+    Stream a Prometheus query and join each batch of series as it is parsed.
+
+    Returns the response without its result, and the samples of the gauge.
+    """
+    url = url / path
+    logger.debug(f"Streaming {url}")
+    samples = {}
+    parser = PrometheusResultParser()
+    async with session.get(url, params=params) as response:
+        response.raise_for_status()
+        if "json" not in response.content_type:
+            raise aiohttp.ContentTypeError(
+                response.request_info,
+                response.history,
+                status=response.status,
+                message=f"Attempt to decode JSON with unexpected mimetype: {response.content_type}",
+                headers=response.headers,
+            )
+        async for chunk in response.content.iter_chunked(STREAM_CHUNK_SIZE):
+            results = parser.feed(chunk)
+            _hub_usage_samples(samples, results, user_group_maps, label_profile)
+    data = parser.close()
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(f"Joined metrics: {samples}")
+    return data, samples
+
+
+@single_flight(_usage_key)
 async def update_group_usage(app: web.Application, config: dict):
     """
     Attach user and group labels for metrics used to populate the User Group Diagnostics dashboard.
+
+    A call while an update of the same metric is running waits for that update.
     """
     logger.info("This is the update_group_usage coroutine.")
-    if not app.get("user_group_map"):
+    hubs = app.get("hub_states") or [app]
+    user_group_maps = {
+        hub["namespace"]: hub["user_group_map"]
+        for hub in hubs
+        if hub.get("user_group_map")
+    }
+    if not user_group_maps:
         logger.info("Doing nothing pending initialization of user_group_map.")
         return
-    namespace = app["namespace"]
+    # Namespace of the hub, or of the first hub in multi-hub mode, where label
+    # profiles without a namespace label are not allowed
+    namespace = hubs[0]["namespace"]
     prometheus_host = app["prometheus_host"]
     prometheus_port = app["prometheus_port"]
     update_metrics_interval = app["update_metrics_interval"]
-    user_group_map = app["user_group_map"]
-    logger.debug(f"User group map: {user_group_map}")
+    label_profile = config.get("label_profile", "full")
     prometheus_api = URL.build(
         scheme="http", host=prometheus_host, port=prometheus_port
     )
-    query = config["query"].replace('namespace=~".*"', f'namespace="{namespace}"')
-    from_date = datetime.utcnow() - timedelta(seconds=update_metrics_interval)
-    to_date = datetime.utcnow()
-    step = str(config["update_interval"]) + "s"
-    parameters = {
-        "query": query,
-        "start": from_date.isoformat() + "Z",
-        "end": to_date.isoformat() + "Z",
-        "step": step,
-    }
+    if len(hubs) == 1:
+        selector = f'namespace="{namespace}"'
+    else:
+        # Query all hubs at once and fan the series out by namespace. Hub
+        # namespaces are validated as Kubernetes namespace names by --hubs.
+        selector = f'namespace=~"{"|".join(hub["namespace"] for hub in hubs)}"'
+    query = config["query"].replace('namespace=~".*"', selector)
+    evaluation_time = config.get("evaluation_time") or datetime.utcnow()
+    to_date = evaluation_time - timedelta(seconds=app["prometheus_eval_offset"])
+    if app["prometheus_query_mode"] == "instant":
+        path = "api/v1/query"
+        parameters = {
+            "query": query,
+            "time": to_date.isoformat() + "Z",
+        }
+    else:
+        path = "api/v1/query_range"
+        from_date = to_date - timedelta(seconds=update_metrics_interval)
+        step = str(config["update_interval"]) + "s"
+        parameters = {
+            "query": query,
+            "start": from_date.isoformat() + "Z",
+            "end": to_date.isoformat() + "Z",
+            "step": step,
+        }
     logger.debug(f"Prometheus query parameters: {parameters}")
-    data = await fetch_page(
-        session=app["session"],
-        url=prometheus_api,
-        path="api/v1/query_range",
-        params=parameters,
-    )
+    if app["prometheus_streaming"]:
+        data, samples = await stream_group_usage_samples(
+            session=app["prometheus_session"],
+            url=prometheus_api,
+            path=path,
+            params=parameters,
+            user_group_maps=user_group_maps,
+            label_profile=label_profile,
+        )
+    else:
+        data = await fetch_page(
+            session=app["prometheus_session"],
+            url=prometheus_api,
+            path=path,
+            params=parameters,
+            executor=app.get("executor"),
+            model=PrometheusResponse,
+        )
+        samples = None
     if data["status"] != "success":
         raise aiohttp.ClientError(f"Bad response from Prometheus: {data}")
-    results = data["data"]["result"]
-    logger.debug(f"Prometheus results: {results}")
-    joined = []
-    for r in results:
-        username = r["metric"]["username"]
-        groups = user_group_map.get(username, [])
-        if not groups:
-            r_copy = copy.deepcopy(r)
-            r_copy["metric"]["usergroup"] = "none"
-            joined.append(r_copy)
-            logger.debug(f"User {username} has no groups, assigning to 'none'.")
-        else:
-            for group in groups:
-                r_copy = copy.deepcopy(r)
-                r_copy["metric"]["usergroup"] = group
-                joined.append(r_copy)
-    logger.debug(f"Joined metrics: {joined}")
+    if samples is None:
+        results = data["data"]["result"]
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"Prometheus results: {results}")
+        samples = await run_in_executor(
+            app.get("join_executor"),
+            _hub_usage_samples,
+            {},
+            results,
+            user_group_maps,
+            label_profile,
+        )
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"Joined metrics: {samples}")
+    logger.info(
+        f"Joined {len(samples)} samples of {config['metric'].name} with user groups."
+    )
     # Export joined metrics
-    config["metric"].clear()
-    for j in joined:
-        config["metric"].labels(
-            namespace=f"{namespace}",
-            username=f"{j['metric']['username']}",
-            username_escaped=_escape_username(j["metric"]["username"]),
-            username_safe=_escape_username_safe(j["metric"]["username"]),
-            usergroup=f"{j['metric']['usergroup']}",
-        ).set(float(j["values"][-1][-1]))
+    usage_aggregation = app["usage_aggregation"]
+    if usage_aggregation in ("group", "both"):
+        config["group_metric"].publish(
+            _aggregate_group_samples(samples, namespace, label_profile)
+        )
+    if usage_aggregation in ("user", "both"):
+        config["metric"].publish(samples)
+    EXPOSITION.invalidate()
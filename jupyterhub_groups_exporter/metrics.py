@@ -1,12 +1,116 @@
+import itertools
+import logging
 import os
+from types import MappingProxyType
+
+from prometheus_client import Counter, Gauge, Histogram
+from prometheus_client.core import GaugeMetricFamily
+from prometheus_client.registry import Collector, CollectorRegistry
+
+logger = logging.getLogger(__name__)
+
+
+class SnapshotGauge(Collector):
+    """
+    A gauge whose samples are replaced all at once.
+
+    Samples are built in the background as a mapping of label values to values
+    and published with a single reference swap, so a scrape always sees a
+    complete and consistent set of samples.
+
+    If max_series is set, samples beyond it are dropped on publish and counted
+    in the dropped series metric, unless the gauge is not capped. Gauges whose
+    published samples are the base of the next update, such as
+    user_group_info, must not be capped, or dropped series would stay dropped.
+    """
+
+    max_series = 0
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: list,
+        namespace: str = "",
+        registry: CollectorRegistry = None,
+        capped: bool = True,
+    ):
+        self.name = f"{namespace}_{name}" if namespace else name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.capped = capped
+        self._samples = MappingProxyType({})
+        if registry is None:
+            registry = EXPORTER_REGISTRY
+        registry.register(self)
+
+    @property
+    def samples(self):
+        """
+        The currently published samples, as a read-only mapping.
+        """
+        return self._samples
+
+    def publish(self, samples: dict):
+        """
+        Replace all samples with a mapping of label value tuples to values.
+        """
+        if self.capped and self.max_series and len(samples) > self.max_series:
+            dropped = len(samples) - self.max_series
+            logger.warning(
+                f"Dropping {dropped} series of {self.name} over the limit of {self.max_series}."
+            )
+            SERIES_DROPPED.labels(metric=self.name).inc(dropped)
+            samples = dict(itertools.islice(samples.items(), self.max_series))
+        self._samples = MappingProxyType(samples)
+        SERIES_EXPORTED.labels(metric=self.name).set(len(samples))
+
+    def clear(self):
+        self.publish({})
+
+    def relabel(self, labelnames: list):
+        """
+        Change the label names of the gauge, clearing its samples.
+        """
+        self.labelnames = tuple(labelnames)
+        self.clear()
+
+    def describe(self):
+        yield GaugeMetricFamily(self.name, self.documentation, labels=self.labelnames)
+
+    def collect(self):
+        samples = self._samples
+        family = GaugeMetricFamily(
+            self.name, self.documentation, labels=self.labelnames
+        )
+        for labelvalues, value in samples.items():
+            family.add_metric(labelvalues, value)
+        yield family
 
-from prometheus_client import Gauge
 
 # Define Prometheus metrics
 
+# Gauges holding exported user and group data live in their own registry, so
+# their exposition can be cached between updates.
+EXPORTER_REGISTRY = CollectorRegistry(auto_describe=True)
+
 namespace = os.environ.get("JUPYTERHUB_METRICS_PREFIX", "jupyterhub")
 
-USER_GROUP = Gauge(
+# Label sets of the usage gauges. The escaped usernames are only needed to join
+# with other metrics, which can be done through user_group_info instead.
+LABEL_PROFILES = {
+    "full": (
+        "namespace",
+        "usergroup",
+        "username",
+        "username_escaped",
+        "username_safe",
+    ),
+    "join_only": ("namespace", "usergroup", "username"),
+    "minimal": ("usergroup", "username"),
+}
+
+USER_GROUP = SnapshotGauge(
     "user_group_info",
     "JupyterHub namespace, username and user group membership information.",
     [
@@ -17,9 +121,10 @@ USER_GROUP = Gauge(
         "username_safe",
     ],
     namespace=namespace,
+    capped=False,
 )
 
-GROUP_USAGE_MEMORY = Gauge(
+GROUP_USAGE_MEMORY = SnapshotGauge(
     "user_group_memory_bytes",
     "Working memory set usage in bytes by user and group.",
     [
@@ -32,7 +137,7 @@ GROUP_USAGE_MEMORY = Gauge(
     namespace=namespace,
 )
 
-GROUP_USAGE_COMPUTE = Gauge(
+GROUP_USAGE_COMPUTE = SnapshotGauge(
     "user_group_cpu_seconds",
     "CPU usage in core seconds by user and group.",
     [
@@ -46,7 +151,7 @@ GROUP_USAGE_COMPUTE = Gauge(
 )
 
 
-GROUP_REQUESTS_MEMORY = Gauge(
+GROUP_REQUESTS_MEMORY = SnapshotGauge(
     "user_group_memory_requests_bytes",
     "Memory requests in bytes by user and group.",
     [
@@ -60,7 +165,7 @@ GROUP_REQUESTS_MEMORY = Gauge(
 )
 
 
-GROUP_REQUESTS_COMPUTE = Gauge(
+GROUP_REQUESTS_COMPUTE = SnapshotGauge(
     "user_group_cpu_requests_seconds",
     "CPU requests in core seconds by user and group.",
     [
@@ -74,7 +179,7 @@ GROUP_REQUESTS_COMPUTE = Gauge(
 )
 
 
-GROUP_HOME_DIR = Gauge(
+GROUP_HOME_DIR = SnapshotGauge(
     "user_group_home_dir_bytes",
     "Home directory usage in bytes by user and group.",
     [
@@ -87,6 +192,191 @@ GROUP_HOME_DIR = Gauge(
     namespace=namespace,
 )
 
+# Usage aggregated by group, with the sum and max over users and the number of
+# users in each group with usage.
+
+GROUP_TOTAL_USAGE_MEMORY = SnapshotGauge(
+    "group_memory_bytes",
+    "Working memory set usage in bytes by group.",
+    [
+        "namespace",
+        "usergroup",
+        "aggregation",
+    ],
+    namespace=namespace,
+)
+
+GROUP_TOTAL_USAGE_COMPUTE = SnapshotGauge(
+    "group_cpu_seconds",
+    "CPU usage in core seconds by group.",
+    [
+        "namespace",
+        "usergroup",
+        "aggregation",
+    ],
+    namespace=namespace,
+)
+
+GROUP_TOTAL_REQUESTS_MEMORY = SnapshotGauge(
+    "group_memory_requests_bytes",
+    "Memory requests in bytes by group.",
+    [
+        "namespace",
+        "usergroup",
+        "aggregation",
+    ],
+    namespace=namespace,
+)
+
+GROUP_TOTAL_REQUESTS_COMPUTE = SnapshotGauge(
+    "group_cpu_requests_seconds",
+    "CPU requests in core seconds by group.",
+    [
+        "namespace",
+        "usergroup",
+        "aggregation",
+    ],
+    namespace=namespace,
+)
+
+GROUP_TOTAL_HOME_DIR = SnapshotGauge(
+    "group_home_dir_bytes",
+    "Home directory usage in bytes by group.",
+    [
+        "namespace",
+        "usergroup",
+        "aggregation",
+    ],
+    namespace=namespace,
+)
+
+# Exporter internals, rendered live from the default registry
+
+USERNAME_CACHE_HITS = Counter(
+    "groups_exporter_username_cache_hits",
+    "Number of username escaping lookups served from the cache.",
+    namespace=namespace,
+)
+
+USERNAME_CACHE_MISSES = Counter(
+    "groups_exporter_username_cache_misses",
+    "Number of username escaping lookups computed on a cache miss.",
+    namespace=namespace,
+)
+
+EVENT_LOOP_LAG = Histogram(
+    "groups_exporter_event_loop_lag_seconds",
+    "Delay of the event loop in waking up a periodic monitor task.",
+    namespace=namespace,
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10),
+)
+
+UPDATE_DURATION = Histogram(
+    "groups_exporter_update_duration_seconds",
+    "Duration of the update jobs, by the metric they update.",
+    ["job"],
+    namespace=namespace,
+    buckets=(0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800),
+)
+
+UPDATE_LAST_SUCCESS = Gauge(
+    "groups_exporter_update_last_success_timestamp_seconds",
+    "Unix time of the last successful run of the update jobs.",
+    ["job"],
+    namespace=namespace,
+)
+
+UPDATE_ERRORS = Counter(
+    "groups_exporter_update_errors",
+    "Number of failed runs of the update jobs, by error type.",
+    ["job", "error"],
+    namespace=namespace,
+)
+
+COALESCED_CALLS = Counter(
+    "groups_exporter_coalesced_calls",
+    "Number of calls that waited for an identical call already in flight.",
+    ["function"],
+    namespace=namespace,
+)
+
+UPDATE_INTERVAL = Gauge(
+    "groups_exporter_update_interval_seconds",
+    "Effective interval between the starts of consecutive runs of the update jobs.",
+    ["job"],
+    namespace=namespace,
+)
+
+FETCH_RETRIES = Counter(
+    "groups_exporter_fetch_retries",
+    "Number of requests to an upstream API retried after an error.",
+    ["function"],
+    namespace=namespace,
+)
+
+SERIES_EXPORTED = Gauge(
+    "groups_exporter_series",
+    "Number of series currently exported by each metric.",
+    ["metric"],
+    namespace=namespace,
+)
+
+SCRAPE_DURATION = Histogram(
+    "groups_exporter_scrape_duration_seconds",
+    "Time taken to render the metrics for a scrape.",
+    namespace=namespace,
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5),
+)
+
+SERIES_DROPPED = Counter(
+    "groups_exporter_series_dropped",
+    "Number of series not exported because a metric exceeded its series limit.",
+    ["metric"],
+    namespace=namespace,
+)
+
+HTTP_REQUESTS_IN_FLIGHT = Gauge(
+    "groups_exporter_http_requests_in_flight",
+    "Number of requests to an upstream API awaiting a response.",
+    ["upstream"],
+    namespace=namespace,
+)
+
+HTTP_CONNECTIONS_QUEUED = Gauge(
+    "groups_exporter_http_connections_queued",
+    "Number of requests to an upstream API waiting for a free pooled connection.",
+    ["upstream"],
+    namespace=namespace,
+)
+
+HTTP_CONNECTIONS_OPENED = Counter(
+    "groups_exporter_http_connections_opened",
+    "Number of new connections opened to an upstream API.",
+    ["upstream"],
+    namespace=namespace,
+)
+
+HTTP_RESPONSES = Counter(
+    "groups_exporter_http_responses",
+    "Number of responses received from an upstream API, by status code.",
+    ["upstream", "status"],
+    namespace=namespace,
+)
+
+HTTP_RECEIVED_BYTES = Counter(
+    "groups_exporter_http_received_bytes",
+    "Number of response body bytes received from an upstream API.",
+    ["upstream"],
+    namespace=namespace,
+)
+
+HTTP_CONNECTIONS_REUSED = Counter(
+    "groups_exporter_http_connections_reused",
+    "Number of requests to an upstream API served on a kept-alive connection.",
+    ["upstream"],
+    namespace=namespace,
+)
+
 # Prometheus usage queries
 
 USAGE_MEMORY = """
@@ -158,18 +448,22 @@ CONFIG_COMPUTE = [
     {
         "query": USAGE_MEMORY,
         "metric": GROUP_USAGE_MEMORY,
+        "group_metric": GROUP_TOTAL_USAGE_MEMORY,
     },
     {
         "query": USAGE_COMPUTE,
         "metric": GROUP_USAGE_COMPUTE,
+        "group_metric": GROUP_TOTAL_USAGE_COMPUTE,
     },
     {
         "query": REQUESTS_MEMORY,
         "metric": GROUP_REQUESTS_MEMORY,
+        "group_metric": GROUP_TOTAL_REQUESTS_MEMORY,
     },
     {
         "query": REQUESTS_COMPUTE,
         "metric": GROUP_REQUESTS_COMPUTE,
+        "group_metric": GROUP_TOTAL_REQUESTS_COMPUTE,
     },
 ]
 
@@ -178,5 +472,20 @@ CONFIG_DIRSIZE = [
     {
         "query": HOME_DIR,
         "metric": GROUP_HOME_DIR,
+        "group_metric": GROUP_TOTAL_HOME_DIR,
     },
 ]
+
+USER_GROUP_MAP_STALE = Gauge(
+    "groups_exporter_user_group_map_stale",
+    "1 if user groups are served from a snapshot pending the first sync with the hub.",
+    ["namespace"],
+    namespace=namespace,
+)
+
+MEMBERSHIP_DELTAS = Counter(
+    "groups_exporter_membership_deltas",
+    "Number of group membership deltas pushed by the hub, by action.",
+    ["action"],
+    namespace=namespace,
+)
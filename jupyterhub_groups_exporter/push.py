@@ -0,0 +1,82 @@
+"""
+Push group membership deltas from JupyterHub to the exporter.
+
+The exporter applies the deltas to its user group map as they arrive, so
+group changes are exported without waiting for the next poll of the JupyterHub
+API. For example, to push the groups of each user managed by the
+authenticator when they log in, add to jupyterhub_config.py:
+
+    from jupyterhub_groups_exporter.push import membership_push_hook
+
+    c.Authenticator.manage_groups = True
+    c.Authenticator.post_auth_hook = membership_push_hook(
+        "http://groups-exporter:8100/services/groups-exporter/memberships"
+    )
+"""
+
+import asyncio
+import logging
+import os
+
+import aiohttp
+
+logger = logging.getLogger(__name__)
+
+
+async def push_membership_deltas(
+    url: str,
+    deltas: list,
+    token: str = None,
+    session: aiohttp.ClientSession = None,
+) -> int:
+    """
+    Send membership deltas to the memberships endpoint of the exporter.
+
+    Each delta is a dict with the 'user' and an 'action': 'add' or 'remove' a
+    'group', 'set' all 'groups' of the user, or 'delete' the user. The token
+    defaults to the GROUPS_EXPORTER_PUSH_TOKEN environment variable. Returns the
+    number of users whose memberships changed.
+    """
+    token = token or os.environ["GROUPS_EXPORTER_PUSH_TOKEN"]
+    headers = {"Authorization": f"token {token}"}
+    if session is None:
+        async with aiohttp.ClientSession() as session:
+            return await push_membership_deltas(url, deltas, token, session)
+    async with session.post(url, json={"deltas": deltas}, headers=headers) as response:
+        response.raise_for_status()
+        return (await response.json())["changed"]
+
+
+def membership_push_hook(url: str, token: str = None, timeout: float = 5) -> callable:
+    """
+    Return an Authenticator.post_auth_hook that pushes the groups of each user
+    to the exporter when they log in.
+
+    Only authenticators that return groups, e.g. with manage_groups enabled,
+    are supported. The hook runs in the login path, so pushes share one session
+    and give up after timeout seconds. Errors are logged and do not prevent the
+    login.
+    """
+    session = None
+
+    async def post_auth_hook(authenticator, handler, authentication: dict) -> dict:
+        nonlocal session
+        groups = authentication.get("groups")
+        if groups is not None:
+            delta = {"action": "set", "user": authentication["name"], "groups": groups}
+            if session is None or session.closed:
+                session = aiohttp.ClientSession(
+                    timeout=aiohttp.ClientTimeout(total=timeout)
+                )
+            try:
+                await push_membership_deltas(url, [delta], token, session)
+            except (
+                aiohttp.ClientError,
+                asyncio.TimeoutError,
+                KeyError,
+                ValueError,
+            ) as e:
+                logger.warning(f"Failed to push groups of {delta['user']}: {e!r}")
+        return authentication
+
+    return post_auth_hook
@@ -0,0 +1,82 @@
+"""
+Generate Prometheus recording rules that aggregate usage by user group.
+
+The rules join the raw usage metrics with the user_group_info metric inside
+Prometheus, so group totals are available without exporting per-user usage.
+Print them with:
+
+    python -m jupyterhub_groups_exporter.rules > jupyterhub-groups-rules.yaml
+"""
+
+import argparse
+import textwrap
+
+from .metrics import CONFIG_COMPUTE, CONFIG_DIRSIZE, USER_GROUP
+
+AGGREGATIONS = ["sum", "max", "count"]
+
+
+def _join_expression(query: str, aggregation: str) -> str:
+    """
+    Aggregate a per-user usage query over the groups of each user.
+    """
+    query = "\n".join(
+        line.rstrip() for line in textwrap.dedent(query).strip().splitlines()
+    )
+    # The home directory query already joins with the default metric name
+    query = query.replace("jupyterhub_user_group_info", USER_GROUP.name)
+    return (
+        f"{aggregation} by (namespace, usergroup) (\n"
+        f"{textwrap.indent(query, '  ')}\n"
+        "  * on (namespace, username) group_right()\n"
+        f"  group by (namespace, username, usergroup) ({USER_GROUP.name})\n"
+        ")"
+    )
+
+
+def recording_rules(jupyterhub_namespace: str = None, interval: str = None) -> str:
+    """
+    Return a Prometheus rule file with one rule per usage metric and aggregation.
+    """
+    lines = ["groups:", "  - name: jupyterhub-groups-exporter"]
+    if interval:
+        lines.append(f"    interval: {interval}")
+    lines.append("    rules:")
+    for config in CONFIG_COMPUTE + CONFIG_DIRSIZE:
+        query = config["query"]
+        if jupyterhub_namespace:
+            query = query.replace(
+                'namespace=~".*"', f'namespace="{jupyterhub_namespace}"'
+            )
+        for aggregation in AGGREGATIONS:
+            expression = _join_expression(query, aggregation)
+            lines.append(
+                f"      - record: namespace_usergroup:{config['metric'].name}:{aggregation}"
+            )
+            lines.append("        expr: |")
+            lines.append(textwrap.indent(expression, " " * 10))
+    return "\n".join(lines) + "\n"
+
+
+def main():
+    argparser = argparse.ArgumentParser(
+        description="Print Prometheus recording rules that aggregate usage by user group."
+    )
+    argparser.add_argument(
+        "--jupyterhub_namespace",
+        default=None,
+        type=str,
+        help="Only aggregate usage in this Kubernetes namespace. Default is all namespaces.",
+    )
+    argparser.add_argument(
+        "--interval",
+        default=None,
+        type=str,
+        help="Evaluation interval of the rule group, e.g. '1m'. Default is the global evaluation interval of Prometheus.",
+    )
+    args = argparser.parse_args()
+    print(recording_rules(args.jupyterhub_namespace, args.interval), end="")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,177 @@
+"""
+Scheduler for the periodic update jobs of the exporter.
+"""
+
+import asyncio
+import logging
+import time
+from datetime import datetime
+
+from aiohttp import web
+
+from .metrics import (
+    EVENT_LOOP_LAG,
+    UPDATE_DURATION,
+    UPDATE_ERRORS,
+    UPDATE_INTERVAL,
+    UPDATE_LAST_SUCCESS,
+)
+
+logger = logging.getLogger(__name__)
+
+
+class Scheduler:
+    """
+    Own all periodic update jobs and the tasks that run them.
+
+    Jobs sharing an update interval are grouped into one batch. Each cycle of a
+    batch runs its jobs concurrently against a shared deadline of one interval,
+    and passes them the same evaluation time so their results describe the same
+    instant. Cycles start at a fixed cadence of one interval after the previous
+    cycle started, not after it finished, so the period does not drift.
+
+    With adaptive intervals, the interval of a batch is doubled when its jobs
+    take most of it, and halved back towards the configured interval once they
+    are fast again. Batches whose jobs are all configured with
+    backoff_when_unchanged, such as membership syncs, also back off while the
+    jobs succeed without reporting changes, and return to the configured
+    interval as soon as one does.
+    """
+
+    loop_lag_interval = 0.5
+    # Fraction of its interval a batch may take before the interval is lengthened
+    slow_batch_fraction = 0.8
+
+    def __init__(
+        self,
+        app: web.Application,
+        adaptive: bool = False,
+        max_interval_factor: int = 4,
+    ):
+        self.app = app
+        self.adaptive = adaptive
+        self.max_interval_factor = max_interval_factor
+        self.batches = {}
+        self.tasks = []
+
+    def add_job(self, update_function: callable, config: dict):
+        interval = int(config["update_interval"])
+        self.batches.setdefault(interval, []).append((update_function, config))
+
+    def start(self):
+        for interval, jobs in self.batches.items():
+            logger.info(f"Scheduling {len(jobs)} jobs every {interval} seconds.")
+            self.tasks.append(asyncio.create_task(self._run_batches(interval, jobs)))
+        self.tasks.append(asyncio.create_task(self._monitor_loop_lag()))
+
+    async def stop(self):
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+
+    @staticmethod
+    def job_name(update_function: callable, config: dict) -> str:
+        """
+        Name a job after the metric it updates, and its hub in multi-hub mode.
+        """
+        name = config["metric"].name if "metric" in config else update_function.__name__
+        if "hub" in config:
+            return f"{name}/{config['hub']['namespace']}"
+        return name
+
+    async def _run_job(self, update_function: callable, config: dict):
+        job = self.job_name(update_function, config)
+        start = time.monotonic()
+        try:
+            data = await update_function(self.app, config)
+            logger.debug(f"Fetched data for {update_function.__name__}: {data}")
+        except Exception as e:
+            UPDATE_ERRORS.labels(job=job, error=type(e).__name__).inc()
+            logger.error(f"Error fetching data for {update_function.__name__}: {e}")
+        else:
+            UPDATE_LAST_SUCCESS.labels(job=job).set_to_current_time()
+            return data
+        finally:
+            UPDATE_DURATION.labels(job=job).observe(time.monotonic() - start)
+
+    async def run_batch(self, interval: float, jobs: list) -> list:
+        """
+        Run one cycle of a batch of jobs, cancelling any that miss the deadline.
+
+        Returns the results of the jobs that finished, None for failed jobs.
+        """
+        evaluation_time = datetime.utcnow()
+        tasks = {
+            asyncio.create_task(
+                self._run_job(
+                    update_function, dict(config, evaluation_time=evaluation_time)
+                )
+            ): self.job_name(update_function, config)
+            for update_function, config in jobs
+        }
+        done, pending = await asyncio.wait(tasks, timeout=interval)
+        for task in pending:
+            logger.error(
+                f"Cancelling {tasks[task]}: not finished within {interval} seconds."
+            )
+            UPDATE_ERRORS.labels(job=tasks[task], error="DeadlineExceeded").inc()
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+        return [task.result() for task in done]
+
+    def next_interval(
+        self, interval: int, jobs: list, current: float, duration: float, results: list
+    ) -> float:
+        """
+        Adapt the interval of a batch to the duration and results of its last cycle.
+        """
+        longest = interval * self.max_interval_factor
+        if duration > self.slow_batch_fraction * current:
+            return min(current * 2, longest)
+        if all(config.get("backoff_when_unchanged") for _, config in jobs):
+            if any(results):
+                return interval
+            # Failed or cancelled jobs do not tell whether anything changed
+            if len(results) < len(jobs) or None in results:
+                return current
+            return min(current * 2, longest)
+        if duration < self.slow_batch_fraction * current / 4:
+            return max(current / 2, interval)
+        return current
+
+    def _export_interval(self, jobs: list, interval: float):
+        for update_function, config in jobs:
+            job = self.job_name(update_function, config)
+            UPDATE_INTERVAL.labels(job=job).set(interval)
+
+    async def _run_batches(self, interval: int, jobs: list):
+        current = interval
+        self._export_interval(jobs, current)
+        next_start = time.monotonic()
+        while True:
+            start = time.monotonic()
+            results = await self.run_batch(current, jobs)
+            if self.adaptive:
+                duration = time.monotonic() - start
+                adapted = self.next_interval(interval, jobs, current, duration, results)
+                if adapted != current:
+                    logger.info(
+                        f"Changing the interval of {len(jobs)} jobs scheduled every {interval} seconds "
+                        f"from {current:g} to {adapted:g} seconds."
+                    )
+                    current = adapted
+                    self._export_interval(jobs, current)
+            # Keep a fixed cadence, unless the batch overran its next start
+            next_start = max(next_start + current, time.monotonic())
+            await asyncio.sleep(next_start - time.monotonic())
+
+    async def _monitor_loop_lag(self):
+        """
+        Measure how late the event loop wakes up from a short sleep.
+        """
+        while True:
+            start = time.monotonic()
+            await asyncio.sleep(self.loop_lag_interval)
+            lag = time.monotonic() - start - self.loop_lag_interval
+            EVENT_LOOP_LAG.observe(max(lag, 0))
@@ -0,0 +1,87 @@
+"""
+HTTP client sessions for the upstream JupyterHub and Prometheus APIs.
+"""
+
+import aiohttp
+
+from .metrics import (
+    HTTP_CONNECTIONS_OPENED,
+    HTTP_CONNECTIONS_QUEUED,
+    HTTP_CONNECTIONS_REUSED,
+    HTTP_RECEIVED_BYTES,
+    HTTP_REQUESTS_IN_FLIGHT,
+    HTTP_RESPONSES,
+)
+
+
+def _trace_config(upstream: str) -> aiohttp.TraceConfig:
+    """
+    Record the requests to an upstream and the usage of its connection pool.
+    """
+    in_flight = HTTP_REQUESTS_IN_FLIGHT.labels(upstream=upstream)
+    queued = HTTP_CONNECTIONS_QUEUED.labels(upstream=upstream)
+    opened = HTTP_CONNECTIONS_OPENED.labels(upstream=upstream)
+    reused = HTTP_CONNECTIONS_REUSED.labels(upstream=upstream)
+    received = HTTP_RECEIVED_BYTES.labels(upstream=upstream)
+
+    async def on_request_start(session, context, params):
+        in_flight.inc()
+
+    async def on_request_exception(session, context, params):
+        in_flight.dec()
+
+    async def on_request_end(session, context, params):
+        in_flight.dec()
+        HTTP_RESPONSES.labels(upstream=upstream, status=params.response.status).inc()
+
+    async def on_response_chunk_received(session, context, params):
+        received.inc(len(params.chunk))
+
+    async def on_connection_queued_start(session, context, params):
+        queued.inc()
+
+    async def on_connection_queued_end(session, context, params):
+        queued.dec()
+
+    async def on_connection_create_end(session, context, params):
+        opened.inc()
+
+    async def on_connection_reuseconn(session, context, params):
+        reused.inc()
+
+    trace_config = aiohttp.TraceConfig()
+    trace_config.on_request_start.append(on_request_start)
+    trace_config.on_request_end.append(on_request_end)
+    trace_config.on_request_exception.append(on_request_exception)
+    trace_config.on_response_chunk_received.append(on_response_chunk_received)
+    trace_config.on_connection_queued_start.append(on_connection_queued_start)
+    trace_config.on_connection_queued_end.append(on_connection_queued_end)
+    trace_config.on_connection_create_end.append(on_connection_create_end)
+    trace_config.on_connection_reuseconn.append(on_connection_reuseconn)
+    return trace_config
+
+
+def client_session(
+    upstream: str,
+    headers: dict = None,
+    connection_limit: int = 8,
+    dns_cache_ttl: int = 300,
+    keepalive_timeout: float = 60,
+) -> aiohttp.ClientSession:
+    """
+    Create a client session with its own connection pool for one upstream API.
+
+    The pool caps the number of concurrent connections to the upstream, caches
+    its DNS lookups and keeps idle connections open between update cycles.
+    """
+    connector = aiohttp.TCPConnector(
+        limit=connection_limit,
+        limit_per_host=connection_limit,
+        ttl_dns_cache=dns_cache_ttl,
+        keepalive_timeout=keepalive_timeout,
+    )
+    return aiohttp.ClientSession(
+        headers=headers,
+        connector=connector,
+        trace_configs=[_trace_config(upstream)],
+    )
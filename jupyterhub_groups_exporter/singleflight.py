@@ -0,0 +1,55 @@
+"""
+Coalescing of concurrent identical calls to upstream APIs and update jobs.
+"""
+
+import asyncio
+import functools
+
+from .metrics import COALESCED_CALLS
+
+
+class _Call:
+    def __init__(self, task: asyncio.Task):
+        self.task = task
+        self.waiters = 0
+
+
+def single_flight(key: callable) -> callable:
+    """
+    Share one in-flight call of a coroutine function between concurrent callers.
+
+    Callers whose arguments map to the same key wait for the call already in
+    flight and receive its result or exception, instead of starting their own.
+    The key function takes the same arguments as the decorated function. The
+    shared call is only cancelled once every caller waiting for it has been.
+    """
+
+    def decorator(func: callable) -> callable:
+        calls = {}
+
+        def forget(k, call: _Call):
+            if calls.get(k) is call:
+                del calls[k]
+
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            k = key(*args, **kwargs)
+            call = calls.get(k)
+            if call is None:
+                call = _Call(asyncio.ensure_future(func(*args, **kwargs)))
+                calls[k] = call
+                call.task.add_done_callback(lambda _: forget(k, call))
+            else:
+                COALESCED_CALLS.labels(function=func.__name__).inc()
+            call.waiters += 1
+            try:
+                return await asyncio.shield(call.task)
+            finally:
+                call.waiters -= 1
+                if call.waiters == 0 and not call.task.done():
+                    forget(k, call)
+                    call.task.cancel()
+
+        return wrapper
+
+    return decorator
@@ -0,0 +1,95 @@
+"""
+On-disk snapshot of the user group map for warm restarts.
+
+After each sync with the hub, the map from usernames to user groups and their
+escaped names are written to a compact file. On startup the exporter loads it,
+so usage metrics can be joined with user groups before the first sync with
+the hub has finished. The snapshot is encoded as MessagePack when msgspec is
+installed, and as JSON otherwise.
+"""
+
+import json
+import logging
+import os
+import tempfile
+import time
+
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_VERSION = 1
+
+
+def _encode(snapshot: dict) -> bytes:
+    if msgspec is not None:
+        return msgspec.msgpack.encode(snapshot)
+    return json.dumps(snapshot, separators=(",", ":")).encode()
+
+
+def _decode(data: bytes) -> dict:
+    if data[:1] == b"{":
+        return json.loads(data)
+    if msgspec is None:
+        raise ValueError("Reading a MessagePack snapshot requires msgspec.")
+    return msgspec.msgpack.decode(data)
+
+
+def save_snapshot(path: str, user_group_map: dict, usernames: dict):
+    """
+    Atomically write the user group map and escaped usernames to a file.
+
+    Each group name is stored once and users refer to their groups by index.
+    """
+    groups = sorted({g for member_of in user_group_map.values() for g in member_of})
+    index = {group: i for i, group in enumerate(groups)}
+    snapshot = {
+        "version": SNAPSHOT_VERSION,
+        "saved": time.time(),
+        "groups": groups,
+        "users": {
+            user: [index[g] for g in member_of]
+            for user, member_of in user_group_map.items()
+        },
+        "usernames": {user: list(escaped) for user, escaped in usernames.items()},
+    }
+    directory = os.path.dirname(os.path.abspath(path))
+    with tempfile.NamedTemporaryFile(dir=directory, delete=False) as f:
+        try:
+            f.write(_encode(snapshot))
+            f.flush()
+            os.fsync(f.fileno())
+        except BaseException:
+            os.unlink(f.name)
+            raise
+    os.replace(f.name, path)
+
+
+def load_snapshot(path: str) -> tuple:
+    """
+    Read a snapshot written by save_snapshot.
+
+    Returns the user group map, the escaped usernames and the Unix time the
+    snapshot was saved. Raises OSError if the file cannot be read and
+    ValueError if it is not a valid snapshot.
+    """
+    with open(path, "rb") as f:
+        data = f.read()
+    try:
+        snapshot = _decode(data)
+        if snapshot["version"] != SNAPSHOT_VERSION:
+            raise ValueError(f"unsupported version {snapshot['version']}")
+        groups = snapshot["groups"]
+        user_group_map = {
+            user: [groups[i] for i in member_of]
+            for user, member_of in snapshot["users"].items()
+        }
+        usernames = {
+            user: tuple(escaped) for user, escaped in snapshot["usernames"].items()
+        }
+        return user_group_map, usernames, snapshot["saved"]
+    except (KeyError, IndexError, TypeError, ValueError) as e:
+        raise ValueError(f"Invalid user group map snapshot {path}: {e}") from e
@@ -40,8 +40,10 @@ c.JupyterHub.load_roles = [
     {
         "name": "groups-exporter",
         "scopes": [
-            "users",
-            "groups",
+            "list:users",
+            "read:users:groups",
+            "list:groups",
+            "read:groups",
         ],
         "services": ["groups-exporter"],
     },
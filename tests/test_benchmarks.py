@@ -0,0 +1,27 @@
+from benchmarks.join import run_benchmark as run_join_benchmark
+from benchmarks.run import run_benchmark
+from benchmarks.user_group_map import run_benchmark as run_user_group_map_benchmark
+
+
+async def test_run_benchmark():
+    """Test that the benchmark suite runs end to end at a small scale."""
+    results = await run_benchmark(users=50, groups=5, memberships=2, repeat=1)
+    assert results["series"]["jupyterhub_user_group_info"] == 150
+    for step in ("update_user_group_info", "update_group_usage", "handle"):
+        assert results["results"][step]["median_seconds"] > 0
+        assert results["results"][step]["peak_memory_bytes"] > 0
+    assert results["exposition_bytes"] > 0
+
+
+def test_join_benchmark():
+    """Test that the join micro-benchmark compares equal joins."""
+    results = run_join_benchmark(series=20, samples=3)
+    for join in ("deepcopy_join", "generator_join"):
+        assert results["results"][join]["samples"] == 40
+
+
+def test_user_group_map_benchmark():
+    """Test that the user group map benchmark skips list scans of large hubs."""
+    results = run_user_group_map_benchmark(users=[10, 100], max_list_scan_users=10)
+    assert results["results"][10]["list_scan_seconds"] is not None
+    assert results["results"][100]["list_scan_seconds"] is None
@@ -0,0 +1,58 @@
+import pytest
+
+from jupyterhub_groups_exporter import decoding
+from jupyterhub_groups_exporter.decoding import HUB_USERS, PrometheusResponse
+
+
+@pytest.mark.parametrize("backend", ["json", "orjson", "msgspec"])
+def test_decode_json(monkeypatch, backend):
+    """Test that every backend decodes the fields the exporter reads."""
+    pytest.importorskip(backend)
+    monkeypatch.setattr(decoding, "BACKEND", backend)
+    monkeypatch.setattr(decoding, "_decoders", {})
+    page = decoding.decode_json(
+        b'{"items": [{"kind": "user", "name": "user-1", "groups": ["group-1"], "admin": false}],'
+        b' "_pagination": {"offset": 0, "limit": 200, "total": 1, "next": null}}',
+        HUB_USERS,
+    )
+    assert page["_pagination"]["total"] == 1
+    assert page["items"][0]["name"] == "user-1"
+    assert page["items"][0]["groups"] == ["group-1"]
+    if backend == "msgspec":
+        assert "admin" not in page["items"][0]
+    data = decoding.decode_json(
+        b'{"status": "success", "data": {"resultType": "vector",'
+        b' "result": [{"metric": {"username": "user-1"}, "value": [1700000000.5, "42"]}]}}',
+        PrometheusResponse,
+    )
+    series = data["data"]["result"][0]
+    assert series["metric"] == {"username": "user-1"}
+    assert float(series["value"][-1]) == 42
+    with pytest.raises(ValueError):
+        decoding.decode_json(b"<html>", PrometheusResponse)
+
+
+def test_prometheus_result_parser():
+    """Test that series are parsed incrementally from arbitrary chunks."""
+    body = (
+        b'{"status":"success","data":{"resultType":"matrix","result":['
+        b'{"metric":{"username":"user-1"},"values":[[1,"1"],[2,"2"]]}, '
+        b'{"metric":{"username":"us\\u00e9r-\\"2\\""},"values":[[1,"3"]]}]},'
+        b'"warnings":["w"]}'
+    )
+    for size in (1, 5, len(body)):
+        parser = decoding.PrometheusResultParser()
+        series = []
+        for i in range(0, len(body), size):
+            series.extend(parser.feed(body[i : i + size]))
+        assert [s["metric"]["username"] for s in series] == ["user-1", 'usér-"2"']
+        assert series[0]["values"][-1] == [2, "2"]
+        assert parser.close() == {
+            "status": "success",
+            "data": {"resultType": "matrix", "result": []},
+            "warnings": ["w"],
+        }
+    parser = decoding.PrometheusResultParser()
+    parser.feed(b'{"status":"success","data":{"resultType":"vector","result":[{"m')
+    with pytest.raises(ValueError):
+        parser.close()
@@ -0,0 +1,51 @@
+import gzip
+
+from prometheus_client import CollectorRegistry
+
+from jupyterhub_groups_exporter.exposition import (
+    CachedExposition,
+    negotiate_encoding,
+    render_metrics,
+)
+from jupyterhub_groups_exporter.metrics import SnapshotGauge
+
+
+def test_cached_exposition_invalidate():
+    """Test that the exposition is only re-rendered after invalidation."""
+    registry = CollectorRegistry()
+    gauge = SnapshotGauge("test_info", "Test gauge.", ["username"], registry=registry)
+    exposition = CachedExposition(registry)
+    gauge.publish({("user-1",): 1})
+    assert b'test_info{username="user-1"} 1.0' in exposition.render()
+    gauge.publish({("user-2",): 1})
+    assert b'test_info{username="user-1"} 1.0' in exposition.render()
+    exposition.invalidate()
+    assert b'test_info{username="user-2"} 1.0' in exposition.render()
+
+
+def test_cached_exposition_gzip():
+    """Test that the cached gzip body and live tail decode as one stream."""
+    registry = CollectorRegistry()
+    gauge = SnapshotGauge("test_info", "Test gauge.", ["username"], registry=registry)
+    exposition = CachedExposition(registry)
+    gauge.publish({(f"user-{i}",): 1 for i in range(1000)})
+    plain = exposition.render(tail=b"tail 1.0\n")
+    compressed = exposition.render(encoding="gzip", tail=b"tail 1.0\n")
+    assert gzip.decompress(compressed) == plain
+    assert plain.endswith(b"tail 1.0\n")
+
+
+def test_negotiate_encoding():
+    """Test that the preferred acceptable encoding is chosen by quality value."""
+    assert negotiate_encoding(None) == "identity"
+    assert negotiate_encoding("gzip") == "gzip"
+    assert negotiate_encoding("gzip;q=0, deflate") == "identity"
+    assert negotiate_encoding("br, gzip;q=0.5") == "gzip"
+
+
+def test_render_metrics_openmetrics():
+    """Test that an OpenMetrics response is terminated exactly once."""
+    body, headers = render_metrics(accept="application/openmetrics-text; version=1.0.0")
+    assert headers["Content-Type"].startswith("application/openmetrics-text")
+    assert body.count(b"# EOF\n") == 1
+    assert body.endswith(b"# EOF\n")
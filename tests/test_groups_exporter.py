@@ -1,8 +1,42 @@
+import argparse
+import asyncio
+import json
 import logging
+import time
+import types
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
 import aiohttp
+import backoff._async
+import pytest
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+from prometheus_client import CollectorRegistry
 from prometheus_client.parser import text_string_to_metric_families
 
+from jupyterhub_groups_exporter import groups_exporter
+from jupyterhub_groups_exporter.app import _hub_state, _hubs
+from jupyterhub_groups_exporter.groups_exporter import (
+    UsernameCache,
+    UserTrace,
+    _aggregate_group_samples,
+    _build_user_group_map,
+    _changed_users,
+    _check_user_model_fields,
+    _hub_usage_samples,
+    _join_user_groups,
+    _user_group_samples,
+    _users_from_groups,
+    run_in_executor,
+    update_group_usage,
+    update_user_group_info,
+)
+from jupyterhub_groups_exporter.metrics import (
+    LABEL_PROFILES,
+    USER_GROUP,
+    SnapshotGauge,
+)
+
 logger = logging.getLogger(__name__)
 
 
@@ -33,17 +67,316 @@ async def test_groups_exporter_alive(admin_request):
 
 async def test_groups_exporter_number(admin_request):
     """Test that the number of groups and users in the exporter matches the hub config."""
-    try:
+    # Wait for the first sync, which may still be backing off while the hub starts
+    deadline = time.monotonic() + 30
+    while True:
         response = await admin_request(
             path="services/groups-exporter/", parse_json=False
         )
-    except Exception:
-        raise aiohttp.ClientError(f"Bad response: {response.status}")
+        if "\njupyterhub_user_group_info{" in response:
+            break
+        if time.monotonic() > deadline:
+            pytest.fail(
+                "jupyterhub_user_group_info was not exported within 30 seconds."
+            )
+        await asyncio.sleep(1)
     logger.debug(f"Response: {response}")
-    if response:
-        for family in text_string_to_metric_families(response):
-            if family.name == "jupyterhub_user_group_info":
-                logger.info(f"{len(family.samples)} groups and users collected.")
-                assert len(family.samples) == 52  # see tests/jupyterhub_config.py
+    for family in text_string_to_metric_families(response):
+        if family.name == "jupyterhub_user_group_info":
+            logger.info(f"{len(family.samples)} groups and users collected.")
+            assert len(family.samples) == 52  # see tests/jupyterhub_config.py
+            break
     else:
-        raise aiohttp.ClientError(f"Bad response: {response.status}")
+        pytest.fail("jupyterhub_user_group_info is missing from the response.")
+
+
+def test_join_user_groups():
+    """Test that Prometheus series are joined with every group of each user."""
+    results = [
+        {"metric": {"username": "user-1"}, "values": [[0, "1"], [15, "2.5"]]},
+        {"metric": {"username": "user-2"}, "value": [15, "3"]},
+    ]
+    user_group_map = {"user-1": ["group-1", "multiple"]}
+    assert list(_join_user_groups(results, user_group_map)) == [
+        ("user-1", "group-1", 2.5),
+        ("user-1", "multiple", 2.5),
+        ("user-2", "none", 3.0),
+    ]
+
+
+def test_incremental_membership_diff():
+    """Test that group member lists are diffed against the previous sync."""
+    previous = {"user-1": ["group-1"], "user-2": ["group-2"], "user-3": ["none"]}
+    groups = [
+        {"kind": "group", "name": "group-1", "users": ["user-1", "user-2"]},
+        {"kind": "group", "name": "group-2", "users": []},
+    ]
+    users = _users_from_groups(groups, previous)
+    assert {u["name"]: u["groups"] for u in users} == {
+        "user-1": ["group-1"],
+        "user-2": ["group-1"],
+        "user-3": [],
+    }
+    current = {"user-1": ["group-1"], "user-2": ["group-1"], "user-3": ["none"]}
+    assert _changed_users(previous, current) == {"user-2"}
+
+
+def test_incremental_duplicate_groups():
+    """Test that duplicate group records do not add users to 'multiple'."""
+    groups = [
+        {"kind": "group", "name": "group-1", "users": ["user-1"]},
+        {"kind": "group", "name": "group-1", "users": ["user-1"]},
+    ]
+    users = _users_from_groups(groups, {})
+    assert users == [{"kind": "user", "name": "user-1", "groups": ["group-1"]}]
+    user_to_groups, users_in_multiple_groups = _build_user_group_map(users, [])
+    assert user_to_groups == {"user-1": ["group-1"]}
+    assert users_in_multiple_groups == set()
+
+
+def test_build_user_group_map():
+    """Test the user group map with allowed groups and multiple memberships."""
+    users = [
+        {"kind": "user", "name": "user-1", "groups": ["group-1", "group-2"]},
+        {"kind": "user", "name": "user-2", "groups": ["group-2", "group-3"]},
+        {"kind": "user", "name": "user-3", "groups": ["group-3"]},
+        {"kind": "user", "name": "user-4", "groups": []},
+    ]
+    user_to_groups, users_in_multiple_groups = _build_user_group_map(
+        users, ["group-1", "group-2"]
+    )
+    assert user_to_groups == {
+        "user-1": ["group-1", "group-2", "multiple"],
+        "user-2": ["group-2", "group-3"],
+        "user-3": ["none"],
+        "user-4": ["none"],
+    }
+    assert users_in_multiple_groups == {"user-1"}
+
+
+async def test_user_group_samples_in_process_pool():
+    """Test that the user group samples can be computed in a worker process."""
+    current = {"user-1": ["group-1"], "user-2": ["group-1", "group-2", "multiple"]}
+    with ProcessPoolExecutor(max_workers=1) as executor:
+        samples, changed = await run_in_executor(
+            executor, _user_group_samples, "ns", None, current, None, False
+        )
+    assert set(changed) == {"user-1", "user-2"}
+    assert {key[:3] for key in samples} == {
+        ("ns", "group-1", "user-1"),
+        ("ns", "multiple", "user-2"),
+    }
+
+
+def test_username_cache_threads():
+    """Test that a small username cache can be shared by concurrent threads."""
+    cache = UsernameCache(maxsize=8)
+    usernames = [f"user-{i}" for i in range(64)] * 50
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        escaped = list(executor.map(cache.get, usernames))
+    assert escaped[1] == ("user-2d1", "user-1")
+    assert len(cache) == 8
+
+
+def test_aggregate_group_samples():
+    """Test that per-user usage is summed, maxed and counted per group."""
+    samples = {
+        ("ns", "group-1", "user-1", "user-1", "user-1"): 1.0,
+        ("ns", "group-1", "user-2", "user-2", "user-2"): 3.0,
+        ("ns", "group-2", "user-2", "user-2", "user-2"): 3.0,
+    }
+    assert _aggregate_group_samples(samples, "ns") == {
+        ("ns", "group-1", "sum"): 4.0,
+        ("ns", "group-1", "max"): 3.0,
+        ("ns", "group-1", "count"): 2,
+        ("ns", "group-2", "sum"): 3.0,
+        ("ns", "group-2", "max"): 3.0,
+        ("ns", "group-2", "count"): 1,
+    }
+
+
+def test_group_usage_label_profiles():
+    """Test that the usage label profiles drop the escaped usernames."""
+    results = [{"metric": {"namespace": "ns", "username": "user-1"}, "value": [0, "2"]}]
+    user_group_maps = {"ns": {"user-1": ["group-1"]}}
+    assert list(_hub_usage_samples({}, results, user_group_maps, "full")) == [
+        ("ns", "group-1", "user-1", "user-2d1", "user-1")
+    ]
+    assert _hub_usage_samples({}, results, user_group_maps, "join_only") == {
+        ("ns", "group-1", "user-1"): 2.0
+    }
+    samples = _hub_usage_samples({}, results, user_group_maps, "minimal")
+    assert samples == {("group-1", "user-1"): 2.0}
+    assert (
+        _aggregate_group_samples(samples, "ns", "minimal")[("ns", "group-1", "sum")]
+        == 2.0
+    )
+
+
+def test_hub_usage_samples():
+    """Test that the series of many hubs are joined with the groups of their hub."""
+    results = [
+        {"metric": {"namespace": "hub-a", "username": "user-1"}, "value": [0, "1"]},
+        {"metric": {"namespace": "hub-b", "username": "user-1"}, "value": [0, "2"]},
+        {"metric": {"namespace": "hub-c", "username": "user-1"}, "value": [0, "3"]},
+    ]
+    user_group_maps = {"hub-a": {"user-1": ["group-1"]}, "hub-b": {"user-2": ["x"]}}
+    samples = _hub_usage_samples({}, results, user_group_maps, "join_only")
+    assert samples == {
+        ("hub-a", "group-1", "user-1"): 1.0,
+        ("hub-b", "none", "user-1"): 2.0,
+    }
+    aggregated = _aggregate_group_samples(samples, None, "join_only")
+    assert aggregated[("hub-a", "group-1", "sum")] == 1.0
+    assert aggregated[("hub-b", "none", "sum")] == 2.0
+    published = {("hub-a", "group-1", "user-1", "user-1", "user-1"): 1}
+    samples, _ = _user_group_samples("hub-b", None, {"user-2": ["x"]}, published, True)
+    assert {key[0] for key in samples} == {"hub-a", "hub-b"}
+
+
+async def test_update_group_usage_single_hub(monkeypatch, tmp_path):
+    """Test that a one-entry --hubs config queries and joins its own namespace."""
+    path = tmp_path / "hubs.json"
+    path.write_text(
+        json.dumps([{"namespace": "hub-a", "hub_url": "http://hub", "api_token": "x"}])
+    )
+    app = web.Application()
+    app.update(
+        namespace=None,
+        headers={},
+        hub_connection_limit=1,
+        dns_cache_ttl=0,
+        keepalive_timeout=0,
+        snapshot_path=None,
+        prometheus_host="127.0.0.1",
+        prometheus_port=9090,
+        prometheus_eval_offset=0,
+        prometheus_query_mode="instant",
+        prometheus_streaming=False,
+        update_metrics_interval=15,
+        usage_aggregation="both",
+        prometheus_session=None,
+    )
+    hub = _hub_state(app, _hubs(str(path))[0])
+    hub["user_group_map"] = {"user-1": ["group-1"]}
+    app["hub_states"] = [hub]
+    queries = []
+
+    async def fetch_page(session, url, path, params, executor, model):
+        queries.append(params["query"])
+        result = [
+            {"metric": {"namespace": "hub-a", "username": "user-1"}, "value": [0, "2"]}
+        ]
+        return {"status": "success", "data": {"result": result}}
+
+    monkeypatch.setattr(groups_exporter, "fetch_page", fetch_page)
+    registry = CollectorRegistry()
+    labelnames = LABEL_PROFILES["join_only"]
+    config = {
+        "query": 'usage{namespace=~".*"}',
+        "metric": SnapshotGauge("usage", "Usage.", labelnames, registry=registry),
+        "group_metric": SnapshotGauge(
+            "group_usage",
+            "Group usage.",
+            ["namespace", "usergroup", "aggregation"],
+            registry=registry,
+        ),
+        "update_interval": 15,
+        "label_profile": "join_only",
+    }
+    try:
+        await update_group_usage(app, config)
+    finally:
+        await hub["hub_session"].close()
+    assert queries == ['usage{namespace="hub-a"}']
+    assert config["metric"].samples == {("hub-a", "group-1", "user-1"): 2.0}
+    assert config["group_metric"].samples[("hub-a", "group-1", "sum")] == 2.0
+
+
+@pytest.mark.parametrize(
+    "status, error", [(403, aiohttp.ClientResponseError), (200, ValueError)]
+)
+async def test_hub_error_keeps_user_group_map(monkeypatch, status, error):
+    """Test that a hub error response does not pass as a hub without users."""
+
+    async def no_sleep(seconds):
+        pass
+
+    monkeypatch.setattr(
+        backoff._async, "asyncio", types.SimpleNamespace(sleep=no_sleep)
+    )
+
+    async def forbidden(request):
+        return web.json_response({"status": 403, "message": "Forbidden"}, status=status)
+
+    hub_api = web.Application()
+    hub_api.router.add_get("/hub/api/users", forbidden)
+    hub_api.router.add_get("/hub/api/groups", forbidden)
+    user_group_map = {"user-1": ["group-1"]}
+    samples, _ = _user_group_samples(
+        "ns", None, user_group_map, dict(USER_GROUP.samples), True
+    )
+    USER_GROUP.publish(samples)
+    async with TestServer(hub_api) as server, aiohttp.ClientSession() as session:
+        app = web.Application()
+        app.update(
+            hub_session=session,
+            hub_url=server.make_url("/"),
+            allowed_groups=[],
+            double_count=True,
+            namespace="ns",
+            user_group_map=user_group_map,
+            user_group_map_lock=asyncio.Lock(),
+            full_sync_interval=0,
+            hub_api_concurrency=2,
+        )
+        with pytest.raises(error):
+            await update_user_group_info(app)
+    assert app["user_group_map"] is user_group_map
+    assert ("ns", "group-1", "user-1", "user-2d1", "user-1") in USER_GROUP.samples
+
+
+async def test_check_user_model_fields(caplog):
+    """Test that user model fields skipped by typed decoding are warned about."""
+
+    async def users(request):
+        assert request.query["limit"] == "1"
+        user = {"kind": "user", "name": "user-1", "groups": [], "servers": {}}
+        return web.json_response({"items": [user], "_pagination": {}})
+
+    hub_api = web.Application()
+    hub_api.router.add_get("/hub/api/users", users)
+    async with TestServer(hub_api) as server, aiohttp.ClientSession() as session:
+        await _check_user_model_fields(session, server.make_url("/"))
+    warnings = [r.getMessage() for r in caplog.records if r.levelname == "WARNING"]
+    assert len(warnings) == 1
+    assert "['servers']" in warnings[0]
+
+
+def test_hubs_namespace_validation(tmp_path):
+    """Test that hub namespaces must be Kubernetes namespace names."""
+    path = tmp_path / "hubs.json"
+    for namespace in ("hub.*", "Hub-A", "hub-a|hub-b", "-hub"):
+        hubs = [{"namespace": namespace, "hub_url": "http://hub", "api_token": "x"}]
+        path.write_text(json.dumps(hubs))
+        with pytest.raises(argparse.ArgumentTypeError):
+            _hubs(str(path))
+
+
+def test_user_trace_rate_limit(caplog):
+    """Test that per-user trace messages are rate-limited and summarised."""
+    trace = UserTrace(rate=2)
+    with caplog.at_level(logging.INFO, "jupyterhub_groups_exporter.groups_exporter"):
+        assert trace.enabled
+        for i in range(5):
+            trace.log(f"user-{i}")
+        trace._window -= 1
+        trace.log("user-5")
+    messages = [record.getMessage() for record in caplog.records]
+    assert messages == [
+        "user-0",
+        "user-1",
+        "Suppressed 3 user trace messages.",
+        "user-5",
+    ]
+    assert not UserTrace(rate=0).enabled
@@ -0,0 +1,46 @@
+from prometheus_client import REGISTRY, CollectorRegistry, generate_latest
+from prometheus_client.parser import text_string_to_metric_families
+
+from jupyterhub_groups_exporter.metrics import USER_GROUP, SnapshotGauge, namespace
+
+
+def test_snapshot_gauge_publish():
+    """Test that publishing a snapshot replaces all previous samples."""
+    registry = CollectorRegistry()
+    gauge = SnapshotGauge(
+        "test_info", "Test gauge.", ["username", "usergroup"], registry=registry
+    )
+    gauge.publish({("user-1", "group-1"): 1, ("user-2", "group-2"): 1})
+    gauge.publish({("user-3", "group-1"): 2})
+    families = list(text_string_to_metric_families(generate_latest(registry).decode()))
+    assert len(families) == 1
+    samples = families[0].samples
+    assert len(samples) == 1
+    assert samples[0].labels == {"username": "user-3", "usergroup": "group-1"}
+    assert samples[0].value == 2
+    gauge.clear()
+    assert registry.get_sample_value("test_info", {"username": "user-3"}) is None
+
+
+def test_snapshot_gauge_max_series(monkeypatch):
+    """Test that series over the limit are dropped and counted."""
+    registry = CollectorRegistry()
+    gauge = SnapshotGauge("test_info", "Test gauge.", ["username"], registry=registry)
+    monkeypatch.setattr(SnapshotGauge, "max_series", 2)
+    gauge.publish({(f"user-{i}",): 1 for i in range(5)})
+    assert list(gauge.samples) == [("user-0",), ("user-1",)]
+    dropped = f"{namespace}_groups_exporter_series_dropped_total"
+    assert REGISTRY.get_sample_value(dropped, {"metric": "test_info"}) == 3
+    uncapped = SnapshotGauge(
+        "test_uncapped_info",
+        "Test gauge.",
+        ["username"],
+        registry=registry,
+        capped=False,
+    )
+    uncapped.publish({(f"user-{i}",): 1 for i in range(5)})
+    assert len(uncapped.samples) == 5
+    assert USER_GROUP.capped is False
+    gauge.relabel(["usergroup", "username"])
+    assert gauge.samples == {}
+    assert gauge.labelnames == ("usergroup", "username")
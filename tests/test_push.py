@@ -0,0 +1,74 @@
+import asyncio
+
+import aiohttp
+import pytest
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+from jupyterhub_groups_exporter.app import handle_memberships
+from jupyterhub_groups_exporter.groups_exporter import _apply_membership_deltas
+from jupyterhub_groups_exporter.metrics import USER_GROUP
+from jupyterhub_groups_exporter.push import membership_push_hook, push_membership_deltas
+
+
+def test_apply_membership_deltas():
+    """Test that deltas are applied to the hub groups of each user."""
+    user_group_map = {"user-1": ["group-1"], "user-2": ["group-1", "multiple"]}
+    deltas = [
+        {"action": "add", "user": "user-1", "group": "group-2"},
+        {"action": "remove", "user": "user-2", "group": "group-1"},
+        {"action": "set", "user": "user-3", "groups": ["group-3"]},
+        {"action": "delete", "user": "user-4"},
+    ]
+    assert _apply_membership_deltas(user_group_map, deltas, []) == {
+        "user-1": ["group-1", "group-2", "multiple"],
+        "user-2": ["none"],
+        "user-3": ["group-3"],
+        "user-4": None,
+    }
+    with pytest.raises(ValueError):
+        _apply_membership_deltas(user_group_map, [{"action": "add", "user": 1}], [])
+
+
+async def test_push_membership_deltas():
+    """Test that pushed deltas replace the user_group_info series of a user."""
+    app = web.Application()
+    app["push_token"] = "secret"
+    app["user_group_map_lock"] = asyncio.Lock()
+    app["allowed_groups"] = []
+    app["namespace"] = "push"
+    app["double_count"] = True
+    app.router.add_post("/memberships", handle_memberships)
+    deltas = [{"action": "add", "user": "user-1", "group": "group-2"}]
+    async with TestServer(app) as server:
+        url = str(server.make_url("/memberships"))
+        with pytest.raises(aiohttp.ClientResponseError) as e:
+            await push_membership_deltas(url, deltas, "secret")
+        assert e.value.status == 503
+        app["user_group_map"] = {"user-1": ["group-1"]}
+        with pytest.raises(aiohttp.ClientResponseError) as e:
+            await push_membership_deltas(url, deltas, "wrong")
+        assert e.value.status == 401
+        assert await push_membership_deltas(url, deltas, "secret") == 1
+    assert app["user_group_map"] == {"user-1": ["group-1", "group-2", "multiple"]}
+    groups = {key[1] for key in USER_GROUP.samples if key[0] == "push"}
+    assert groups == {"group-1", "group-2", "multiple"}
+
+
+async def test_membership_push_hook_timeout(caplog):
+    """Test that a slow exporter does not hold up or fail the login."""
+
+    async def slow(request):
+        await asyncio.sleep(5)
+        return web.json_response({"changed": 1})
+
+    app = web.Application()
+    app.router.add_post("/memberships", slow)
+    authentication = {"name": "user-1", "groups": ["group-1"]}
+    async with TestServer(app) as server:
+        hook = membership_push_hook(
+            str(server.make_url("/memberships")), "secret", timeout=0.1
+        )
+        result = await asyncio.wait_for(hook(None, None, authentication), timeout=2)
+    assert result is authentication
+    assert "Failed to push groups of user-1" in caplog.text
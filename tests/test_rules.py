@@ -0,0 +1,17 @@
+import yaml
+
+from jupyterhub_groups_exporter.metrics import CONFIG_COMPUTE, CONFIG_DIRSIZE
+from jupyterhub_groups_exporter.rules import recording_rules
+
+
+def test_recording_rules():
+    """Test that one rule is generated per usage metric and aggregation."""
+    rules = yaml.safe_load(recording_rules("my-hub", "1m"))
+    group = rules["groups"][0]
+    assert group["interval"] == "1m"
+    assert len(group["rules"]) == 3 * len(CONFIG_COMPUTE + CONFIG_DIRSIZE)
+    rule = group["rules"][0]
+    assert rule["record"].startswith("namespace_usergroup:")
+    assert rule["expr"].startswith("sum by (namespace, usergroup) (")
+    assert 'namespace="my-hub"' in rule["expr"]
+    assert 'namespace=~".*"' not in rule["expr"]
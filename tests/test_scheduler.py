@@ -0,0 +1,77 @@
+import asyncio
+
+from prometheus_client import REGISTRY
+
+from jupyterhub_groups_exporter.metrics import namespace
+from jupyterhub_groups_exporter.scheduler import Scheduler
+
+
+async def test_run_batch():
+    """Test that a batch shares one evaluation time and cancels late jobs."""
+    evaluation_times = []
+
+    async def fast(app, config):
+        evaluation_times.append(config["evaluation_time"])
+
+    async def slow(app, config):
+        evaluation_times.append(config["evaluation_time"])
+        await asyncio.sleep(10)
+
+    scheduler = Scheduler(app={})
+    scheduler.add_job(fast, {"update_interval": 1})
+    scheduler.add_job(slow, {"update_interval": 1})
+    assert list(scheduler.batches) == [1]
+    await asyncio.wait_for(scheduler.run_batch(1, scheduler.batches[1]), timeout=5)
+    assert len(evaluation_times) == 2
+    assert evaluation_times[0] == evaluation_times[1]
+
+
+async def test_run_job_metrics():
+    """Test that job durations, successes and errors are recorded."""
+
+    async def succeed(app, config):
+        pass
+
+    async def fail(app, config):
+        raise ValueError("Bad data")
+
+    prefix = f"{namespace}_groups_exporter_update"
+    scheduler = Scheduler(app={})
+    await scheduler._run_job(succeed, {})
+    await scheduler._run_job(fail, {})
+    assert REGISTRY.get_sample_value(
+        f"{prefix}_last_success_timestamp_seconds", {"job": "succeed"}
+    )
+    assert (
+        REGISTRY.get_sample_value(
+            f"{prefix}_errors_total", {"job": "fail", "error": "ValueError"}
+        )
+        == 1
+    )
+    assert (
+        REGISTRY.get_sample_value(f"{prefix}_duration_seconds_count", {"job": "fail"})
+        == 1
+    )
+
+
+def test_next_interval():
+    """Test that adaptive intervals follow churn and batch durations."""
+
+    async def update(app, config):
+        pass
+
+    scheduler = Scheduler(app={}, adaptive=True, max_interval_factor=4)
+    usage = [(update, {"update_interval": 10})]
+    info = [(update, {"update_interval": 10, "backoff_when_unchanged": True})]
+    # Slow batches are lengthened up to the maximum factor
+    assert scheduler.next_interval(10, usage, 10, 9, [None]) == 20
+    assert scheduler.next_interval(10, usage, 40, 39, [None]) == 40
+    # Fast batches return towards the configured interval
+    assert scheduler.next_interval(10, usage, 40, 1, [None]) == 20
+    assert scheduler.next_interval(10, usage, 10, 1, [None]) == 10
+    # Membership syncs back off while nothing changes
+    assert scheduler.next_interval(10, info, 10, 1, [0]) == 20
+    assert scheduler.next_interval(10, info, 20, 1, [0, 3]) == 10
+    # Failed or cancelled membership syncs keep the current interval
+    assert scheduler.next_interval(10, info, 20, 1, [None]) == 20
+    assert scheduler.next_interval(10, info, 20, 1, []) == 20
@@ -0,0 +1,34 @@
+import asyncio
+
+from aiohttp import web
+from prometheus_client import REGISTRY
+
+from jupyterhub_groups_exporter.metrics import namespace
+from jupyterhub_groups_exporter.sessions import client_session
+
+
+async def test_client_session_pool(aiohttp_server):
+    """Test that concurrent requests share the capped connection pool."""
+
+    async def handler(request):
+        await asyncio.sleep(0.01)
+        return web.json_response(
+            {"authorization": request.headers.get("Authorization")}
+        )
+
+    app = web.Application()
+    app.router.add_get("/", handler)
+    server = await aiohttp_server(app)
+    async with client_session("test", connection_limit=2) as session:
+
+        async def fetch():
+            async with session.get(server.make_url("/")) as response:
+                return await response.json()
+
+        results = await asyncio.gather(*(fetch() for _ in range(10)))
+    assert results == [{"authorization": None}] * 10
+    labels = {"upstream": "test"}
+    prefix = f"{namespace}_groups_exporter_http"
+    assert REGISTRY.get_sample_value(f"{prefix}_connections_opened_total", labels) == 2
+    assert REGISTRY.get_sample_value(f"{prefix}_connections_reused_total", labels) == 8
+    assert REGISTRY.get_sample_value(f"{prefix}_requests_in_flight", labels) == 0
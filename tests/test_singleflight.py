@@ -0,0 +1,60 @@
+import asyncio
+
+import pytest
+from prometheus_client import REGISTRY
+
+from jupyterhub_groups_exporter.metrics import namespace
+from jupyterhub_groups_exporter.singleflight import single_flight
+
+
+async def test_single_flight():
+    """Test that concurrent identical calls share one call and its result."""
+    calls = []
+    release = asyncio.Event()
+
+    @single_flight(lambda value: value)
+    async def fetch(value):
+        calls.append(value)
+        await release.wait()
+        return [value]
+
+    first = asyncio.create_task(fetch(1))
+    second = asyncio.create_task(fetch(1))
+    other = asyncio.create_task(fetch(2))
+    await asyncio.sleep(0)
+    # Cancelling one caller leaves the shared call running for the other
+    first.cancel()
+    await asyncio.sleep(0)
+    release.set()
+    assert await second == [1]
+    assert await other == [2]
+    with pytest.raises(asyncio.CancelledError):
+        await first
+    assert calls == [1, 2]
+    assert (
+        REGISTRY.get_sample_value(
+            f"{namespace}_groups_exporter_coalesced_calls_total", {"function": "fetch"}
+        )
+        == 1
+    )
+    # A new call starts once the previous one has finished
+    assert await fetch(1) == [1]
+    assert calls == [1, 2, 1]
+
+
+async def test_single_flight_cancelled():
+    """Test that the shared call is cancelled with its last caller."""
+    cancelled = asyncio.Event()
+
+    @single_flight(lambda: None)
+    async def hang():
+        try:
+            await asyncio.sleep(10)
+        except asyncio.CancelledError:
+            cancelled.set()
+            raise
+
+    task = asyncio.create_task(hang())
+    await asyncio.sleep(0)
+    task.cancel()
+    await asyncio.wait_for(cancelled.wait(), timeout=1)
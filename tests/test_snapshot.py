@@ -0,0 +1,69 @@
+import pytest
+from aiohttp import web
+from prometheus_client import REGISTRY
+
+from benchmarks.run import run_benchmark
+from jupyterhub_groups_exporter import groups_exporter, snapshot
+from jupyterhub_groups_exporter.groups_exporter import (
+    USERNAMES,
+    UsernameCache,
+    restore_user_group_map,
+)
+from jupyterhub_groups_exporter.metrics import USER_GROUP, namespace
+from jupyterhub_groups_exporter.snapshot import load_snapshot, save_snapshot
+
+
+@pytest.mark.parametrize("encoding", ["json", "msgpack"])
+def test_snapshot_round_trip(monkeypatch, tmp_path, encoding):
+    """Test that a saved snapshot loads back the same user group map."""
+    if encoding == "json":
+        monkeypatch.setattr(snapshot, "msgspec", None)
+    else:
+        pytest.importorskip("msgspec")
+    path = tmp_path / "user-groups.snapshot"
+    user_group_map = {"user-1": ["group-1", "group-2"], "user-2": ["none"]}
+    usernames = {"user-1": ("user-2d1", "user-1")}
+    save_snapshot(str(path), user_group_map, usernames)
+    assert load_snapshot(str(path))[:2] == (user_group_map, usernames)
+    assert list(tmp_path.iterdir()) == [path]
+    path.write_bytes(b"{}")
+    with pytest.raises(ValueError):
+        load_snapshot(str(path))
+
+
+def test_restore_user_group_map(tmp_path):
+    """Test that user groups are served from a snapshot until the first sync."""
+    path = tmp_path / "user-groups.snapshot"
+    save_snapshot(str(path), {"user-1": ["group-1"]}, {"user-1": ("u1", "u1")})
+    app = web.Application()
+    app["snapshot_path"] = str(path)
+    app["namespace"] = "ns"
+    app["double_count"] = True
+    restore_user_group_map(app)
+    assert app["user_group_map"] == {"user-1": ["group-1"]}
+    assert app["user_group_map_stale"]
+    assert USERNAMES.get("user-1") == ("u1", "u1")
+    assert ("ns", "group-1", "user-1", "u1", "u1") in USER_GROUP.samples
+    assert (
+        REGISTRY.get_sample_value(
+            f"{namespace}_groups_exporter_user_group_map_stale", {"namespace": "ns"}
+        )
+        == 1
+    )
+    app = web.Application()
+    app["snapshot_path"] = str(tmp_path / "missing.snapshot")
+    restore_user_group_map(app)
+    assert "user_group_map" not in app
+
+
+async def test_snapshot_usernames_with_process_pool(monkeypatch, tmp_path):
+    """Test that snapshots keep escaped usernames computed in worker processes."""
+    monkeypatch.setattr(groups_exporter, "USERNAMES", UsernameCache())
+    path = tmp_path / "user-groups.snapshot"
+    await run_benchmark(
+        users=20, groups=2, repeat=1, worker_pool="process", snapshot_path=str(path)
+    )
+    user_group_map, usernames, _ = load_snapshot(str(path))
+    assert len(user_group_map) == 20
+    assert usernames.keys() == user_group_map.keys()
+    assert usernames["user-1"] == ("user-2d1", "user-1")